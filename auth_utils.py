@@ -1,28 +1,106 @@
 import os
+import asyncio
 import bcrypt
+import hashlib
+import hmac
 import secrets
+import threading
+import time
+from collections import OrderedDict
 from typing import Optional
 from fastapi import Request, HTTPException, status, Header
+from fastapi.responses import RedirectResponse
+from starlette.routing import get_route_path
 
 ADMIN_HASH = os.getenv("ADMIN_PASSWORD_HASH")
 _API_TOKEN = os.getenv("N8N_API_TOKEN")
 
-def verify_password(password: str) -> bool:
-    if not ADMIN_HASH:
-        return False
-    return bcrypt.checkpw(password.encode(), ADMIN_HASH.encode())
+# With no admin hash configured we still run bcrypt (against a well-formed
+# hash that never matches) so "login disabled" and "wrong password" take the
+# same time.
+_ADMIN_ENABLED = bool(ADMIN_HASH)
+_ADMIN_HASH_BYTES = ADMIN_HASH.encode() if ADMIN_HASH else b"$2b$12$" + b"." * 53
+
+# Recent bcrypt results, keyed by an HMAC of the password under a per-process
+# random key (the raw password is never stored). Short TTL so repeated form
+# submissions skip the KDF without turning this into a long-lived oracle.
+_VERIFY_TTL = 5.0
+_VERIFY_CACHE_MAX = 64
+_verify_key = secrets.token_bytes(32)
+_verify_cache: "OrderedDict[bytes, tuple]" = OrderedDict()
+_verify_lock = threading.Lock()
+
+def _check_password(password: str) -> bool:
+    key = hmac.new(_verify_key, password.encode(), hashlib.sha256).digest()
+    now = time.monotonic()
+    with _verify_lock:
+        hit = _verify_cache.get(key)
+        if hit and hit[0] > now:
+            return hit[1]
+    ok = bcrypt.checkpw(password.encode(), _ADMIN_HASH_BYTES) & _ADMIN_ENABLED
+    with _verify_lock:
+        _verify_cache[key] = (now + _VERIFY_TTL, ok)
+        _verify_cache.move_to_end(key)
+        while len(_verify_cache) > _VERIFY_CACHE_MAX:
+            _verify_cache.popitem(last=False)
+    return ok
+
+async def verify_password(password: str) -> bool:
+    # bcrypt blocks for tens of ms; keep it off the event loop.
+    return await asyncio.to_thread(_check_password, password)
 
 def is_authenticated(request: Request) -> bool:
     return request.session.get("logged_in", False)
 
-def require_login(request: Request):
-    if not is_authenticated(request):
-        raise HTTPException(status_code=status.HTTP_303_SEE_OTHER, headers={"Location": "/chat/login"})
+class LoginRequiredMiddleware:
+    """Send anyone without a logged-in session to the login page, once, before
+    routing. Exact `public` paths and anything under `public_prefixes` (the
+    token-guarded API, static files, login itself) pass straight through.
+    Must sit inside SessionMiddleware so scope["session"] is populated."""
+
+    def __init__(self, app, login_url: str = "/chat/login", public=(), public_prefixes=()):
+        self.app = app
+        self.login_url = login_url
+        self.public = frozenset(public)
+        self.public_prefixes = tuple(public_prefixes)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http":
+            path = get_route_path(scope) or "/"
+            if not (
+                path in self.public
+                or path.startswith(self.public_prefixes)
+                or scope.get("session", {}).get("logged_in", False)
+            ):
+                response = RedirectResponse(self.login_url, status_code=status.HTTP_303_SEE_OTHER)
+                await response(scope, receive, send)
+                return
+        await self.app(scope, receive, send)
 
 # Fail closed so you don't think it's protected when it isn't.
 if not _API_TOKEN:
     raise RuntimeError("N8N_API_TOKEN is not set. Add it to .env and restart the server.")
 
+_API_TOKEN_BYTES = _API_TOKEN.encode()
+
+def _token_ok(authorization: Optional[str], x_api_token: Optional[str]) -> bool:
+    # A non-empty Bearer credential decides on its own; X-API-Token is only
+    # consulted without one. Compared as bytes so non-ASCII input is a plain
+    # mismatch rather than a TypeError from compare_digest.
+    candidate = None
+    if authorization and authorization[:7].lower() == "bearer ":
+        candidate = authorization[7:].strip()
+    if not candidate and x_api_token:
+        candidate = x_api_token.strip()
+    return bool(candidate) and secrets.compare_digest(candidate.encode(), _API_TOKEN_BYTES)
+
+def _unauthorized() -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail="Invalid or missing token",
+        headers={"WWW-Authenticate": "Bearer"},
+    )
+
 async def require_bearer_token(
     authorization: Optional[str] = Header(default=None),
     x_api_token: Optional[str] = Header(default=None),
@@ -32,22 +110,8 @@ async def require_bearer_token(
       - Authorization: Bearer <token>
       - X-API-Token: <token>
     """
-    candidate: Optional[str] = None
-
-    if authorization:
-        parts = authorization.split(" ", 1)
-        if len(parts) == 2 and parts[0].lower() == "bearer":
-            candidate = parts[1].strip()
-
-    if not candidate and x_api_token:
-        candidate = x_api_token.strip()
-
-    if not (candidate and secrets.compare_digest(candidate, _API_TOKEN)):
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Invalid or missing token",
-            headers={"WWW-Authenticate": "Bearer"},
-        )
+    if not _token_ok(authorization, x_api_token):
+        raise _unauthorized()
 
 # EITHER a logged-in session OR a valid API token
 async def require_api_auth(
@@ -60,19 +124,5 @@ async def require_api_auth(
         return
 
     # 2) Otherwise require a bearer token (or X-API-Token)
-    candidate: Optional[str] = None
-
-    if authorization:
-        parts = authorization.split(" ", 1)
-        if len(parts) == 2 and parts[0].lower() == "bearer":
-            candidate = parts[1].strip()
-
-    if not candidate and x_api_token:
-        candidate = x_api_token.strip()
-
-    if not (candidate and secrets.compare_digest(candidate, _API_TOKEN)):
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Invalid or missing token",
-            headers={"WWW-Authenticate": "Bearer"},
-        )
+    if not _token_ok(authorization, x_api_token):
+        raise _unauthorized()
@@ -1,11 +1,15 @@
 # codeideas_db.py
 import os
+import threading
 import pymysql
-from dotenv import load_dotenv
 
-load_dotenv()
+# .env is loaded once by main.py; settings are read at connect time.
 
-def get_codeideas_connection():
+# One long-lived connection per thread (the API calls in via asyncio.to_thread),
+# like memory.py's SQLite handles, instead of a TCP connect + auth per query.
+_local = threading.local()
+
+def _connect():
     return pymysql.connect(
         host=os.getenv("CODEIDEAS_DB_HOST"),
         user=os.getenv("CODEIDEAS_DB_USER"),
@@ -15,59 +19,60 @@ def get_codeideas_connection():
         autocommit=True,
     )
 
+def get_codeideas_connection():
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = _local.conn = _connect()
+    else:
+        # Reconnects if the server dropped the idle connection (wait_timeout).
+        conn.ping(reconnect=True)
+    return conn
+
 def list_code_ideas(limit=200, status=None, language=None, difficulty=None, search=None):
-    conn = get_codeideas_connection()
-    try:
-        where = []
-        params = []
+    where = []
+    params = []
 
-        if status:
-            where.append("status = %s")
-            params.append(status)
+    if status:
+        where.append("status = %s")
+        params.append(status)
 
-        if language:
-            where.append("language = %s")
-            params.append(language)
+    if language:
+        where.append("language = %s")
+        params.append(language)
 
-        if difficulty:
-            where.append("difficulty = %s")
-            params.append(difficulty)
+    if difficulty:
+        where.append("difficulty = %s")
+        params.append(difficulty)
 
-        if search:
-            where.append("""
-                (
-                    module_name LIKE %s OR
-                    filename LIKE %s OR
-                    purpose LIKE %s OR
-                    category LIKE %s
-                )
-            """)
-            term = f"%{search}%"
-            params.extend([term, term, term, term])
+    if search:
+        where.append("""
+            (
+                module_name LIKE %s OR
+                filename LIKE %s OR
+                purpose LIKE %s OR
+                category LIKE %s
+            )
+        """)
+        term = f"%{search}%"
+        params.extend([term, term, term, term])
 
-        where_sql = "WHERE " + " AND ".join(where) if where else ""
+    where_sql = "WHERE " + " AND ".join(where) if where else ""
 
-        sql = f"""
-            SELECT *
-            FROM code_ideas
-            {where_sql}
-            ORDER BY created_at DESC
-            LIMIT %s
-        """
+    sql = f"""
+        SELECT *
+        FROM code_ideas
+        {where_sql}
+        ORDER BY created_at DESC
+        LIMIT %s
+    """
 
-        params.append(limit)
+    params.append(limit)
 
-        with conn.cursor() as cur:
-            cur.execute(sql, params)
-            return cur.fetchall()
-    finally:
-        conn.close()
+    with get_codeideas_connection().cursor() as cur:
+        cur.execute(sql, params)
+        return cur.fetchall()
 
 def get_code_idea(idea_id: int):
-    conn = get_codeideas_connection()
-    try:
-        with conn.cursor() as cur:
-            cur.execute("SELECT * FROM code_ideas WHERE id = %s", (idea_id,))
-            return cur.fetchone()
-    finally:
-        conn.close()
\ No newline at end of file
+    with get_codeideas_connection().cursor() as cur:
+        cur.execute("SELECT * FROM code_ideas WHERE id = %s", (idea_id,))
+        return cur.fetchone()
\ No newline at end of file
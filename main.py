@@ -1,44 +1,85 @@
 from dotenv import load_dotenv
 load_dotenv()
 
+import asyncio
 import os
-from fastapi import FastAPI, Form, Request, HTTPException, Body, Depends
-from fastapi.responses import FileResponse,HTMLResponse, JSONResponse, RedirectResponse
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from types import MappingProxyType
+from fastapi import FastAPI, Form, Request, HTTPException, Depends, Query
+from fastapi.responses import FileResponse,HTMLResponse, ORJSONResponse, RedirectResponse, Response
 from fastapi.templating import Jinja2Templates
-from starlette.middleware.sessions import SessionMiddleware
-from pydantic import BaseModel
+from jinja2 import FileSystemBytecodeCache
+from jinja2.utils import htmlsafe_json_dumps
+from pydantic import BaseModel, ConfigDict, Field, field_validator
 from datetime import datetime, timezone
 from zoneinfo import ZoneInfo
 from typing import Optional
 from model_runner import AVAILABLE_MODELS
-from auth_utils import verify_password, require_login, require_api_auth
+from auth_utils import LoginRequiredMiddleware, verify_password, require_api_auth
 from codeideas_db import list_code_ideas, get_code_idea
+from session_middleware import SessionMiddleware
+from static_files import PrecompressedStaticFiles
 
 from memory import (
-    add_message,
-    queue_prompt,
-    get_db_connection,
+    enqueue_turn,
     get_conversation_messages,
+    conversation_version,
     list_conversations,
     ensure_conversation,
     create_conversation,
     list_jobs,
+    list_job_summaries,
     get_job,
-    last_model_for_conversation,
-    last_system_for_conversation,
+    last_model_and_system,
+    last_message_content,
+    latest_assistant_content,
 )
 
-app = FastAPI(root_path="/chat")
+# Threads for asyncio.to_thread (SQLite helpers, bcrypt). Each one keeps its
+# own pair of SQLite connections, so this also bounds open handles.
+API_THREADS = int(os.getenv("API_THREADS", "32"))
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=API_THREADS, thread_name_prefix="api")
+    )
+    yield
+
+app = FastAPI(root_path="/chat", default_response_class=ORJSONResponse, lifespan=lifespan)
+# Every page needs a logged-in session except these; /api/* checks its own
+# auth (session or token) per route.
+app.add_middleware(
+    LoginRequiredMiddleware,
+    public={"/login", "/logout", app.docs_url, app.redoc_url, app.openapi_url,
+            app.swagger_ui_oauth2_redirect_url},
+    public_prefixes=("/api/", "/static/"),
+)
+# Added last so it runs first and fills scope["session"] for the check above.
 app.add_middleware(SessionMiddleware, secret_key=os.getenv("SECRET_KEY"))
 
+# Optional static assets; pre-generated .br/.gz siblings are preferred.
+if os.path.isdir("static"):
+    app.mount("/static", PrecompressedStaticFiles(directory="static"), name="static")
+
 # --------------------------------------------------------------------
 # Templates & Globals
 # --------------------------------------------------------------------
 templates = Jinja2Templates(directory="templates")
+# Templates only change on deploy; skip the per-render mtime stat unless asked.
+templates.env.auto_reload = os.getenv("TEMPLATES_AUTO_RELOAD", "0") == "1"
+# Optional compiled-template cache so restarts and extra uvicorn workers skip
+# parsing. Jinja's default location is a private per-user temp dir.
+if os.getenv("TEMPLATES_BYTECODE_CACHE", "0") == "1":
+    templates.env.bytecode_cache = FileSystemBytecodeCache()
 templates.env.globals["root_path"] = "/chat/"
-templates.env.globals["AVAILABLE_MODELS"] = AVAILABLE_MODELS
+templates.env.globals["AVAILABLE_MODELS"] = tuple(AVAILABLE_MODELS)
+# Same output as `AVAILABLE_MODELS | tojson`, serialised once instead of per render.
+templates.env.globals["AVAILABLE_MODELS_JSON"] = htmlsafe_json_dumps(list(AVAILABLE_MODELS))
 
-SYSTEM_PRESETS = [
+# Shared by every request (and a Jinja global), so each preset is read-only.
+SYSTEM_PRESETS = tuple(MappingProxyType(p) for p in (
 	{
 		"name": "Code Related (PHP,Python,C++",
 		"text": (
@@ -155,38 +196,67 @@ SYSTEM_PRESETS = [
             "Keep plans actionable and scoped for delivery."
         ),
     },
-]
+))
 templates.env.globals["SYSTEM_PRESETS"] = SYSTEM_PRESETS
 
 # --------------------------------------------------------------------
 # Models
 # --------------------------------------------------------------------
+# Size caps are enforced by pydantic-core before handler code runs.
+MAX_CONTENT_CHARS = int(os.getenv("MAX_CONTENT_CHARS", "32768"))
+MAX_SYSTEM_CHARS = int(os.getenv("MAX_SYSTEM_CHARS", "8192"))
+# Rows per /jobs/rows or /api/jobs response, so one request can't materialise
+# the whole queue table.
+MAX_JOB_ROWS = int(os.getenv("MAX_JOB_ROWS", "500"))
+
 class CreateJobRequest(BaseModel):
-    model: str
-    content: str
-    conversation_id: str
-    system_prompt: str = ""
-    grammar_name: Optional[str] = None
+    # Lenient like the old dict handling: strings are stripped, null means
+    # "not given", and a blank model falls back to mistral.
+    model_config = ConfigDict(extra="ignore", frozen=True, str_strip_whitespace=True)
+
+    model: str = Field(default="mistral", max_length=128)
+    content: str = Field(default="", max_length=MAX_CONTENT_CHARS)
+    conversation_id: str = Field(default="", max_length=128)
+    system_prompt: str = Field(default="", max_length=MAX_SYSTEM_CHARS)
+    assistant_context: str = Field(default="", max_length=MAX_CONTENT_CHARS)
+    grammar_name: Optional[str] = Field(default=None, max_length=128)
+
+    @field_validator("model", "content", "conversation_id", "system_prompt", "assistant_context", mode="before")
+    @classmethod
+    def _null_as_blank(cls, v):
+        return "" if v is None else v
+
+    @field_validator("model")
+    @classmethod
+    def _default_model(cls, v: str) -> str:
+        return v or "mistral"
+
+    @field_validator("grammar_name")
+    @classmethod
+    def _blank_grammar_is_none(cls, v: Optional[str]) -> Optional[str]:
+        return v or None
 
 class ReplyRequest(BaseModel):
-    model: str
-    content: str
-    system_prompt: str = ""
-    assistant_context: Optional[str] = None
-    grammar_name: Optional[str] = None
+    model_config = ConfigDict(extra="ignore", frozen=True)
+
+    model: str = Field(max_length=128)
+    content: str = Field(max_length=MAX_CONTENT_CHARS)
+    system_prompt: str = Field(default="", max_length=MAX_SYSTEM_CHARS)
+    assistant_context: Optional[str] = Field(default=None, max_length=MAX_CONTENT_CHARS)
+    grammar_name: Optional[str] = Field(default=None, max_length=128)
 
 # --------------------------------------------------------------------
 # Helpers
 # --------------------------------------------------------------------
-def status_badge(status: str) -> str:
-    colors = {
-        "done": "bg-green-600",
-        "processing": "bg-blue-600",
-        "queued": "bg-yellow-500",
-        "error": "bg-red-600",
-        "failed": "bg-red-600",
-    }
-    dot = colors.get(status.lower(), "bg-gray-500")
+_BADGE_COLORS = {
+    "done": "bg-green-600",
+    "processing": "bg-blue-600",
+    "queued": "bg-yellow-500",
+    "error": "bg-red-600",
+    "failed": "bg-red-600",
+}
+
+def _render_badge(status: str, dot: str) -> str:
     return f"""
       <span class="inline-flex items-center gap-2 px-2 py-1 rounded-full bg-gray-800 border border-gray-700 text-xs">
         <span class="inline-block w-2.5 h-2.5 rounded-full {dot}"></span>
@@ -194,11 +264,11 @@ def status_badge(status: str) -> str:
       </span>
     """
 
-def enqueue_user_message(conversation_id: str, content: str, model: str, system_prompt: str = "", grammar_name: str = None) -> int:
-    if system_prompt:
-        add_message(conversation_id, "system", system_prompt)
-    add_message(conversation_id, "user", content)
-    return queue_prompt(conversation_id, content, model, system_prompt, grammar_name)
+# Known statuses are rendered once at import; /jobs/rows just looks them up.
+_BADGES = {s: _render_badge(s, dot) for s, dot in _BADGE_COLORS.items()}
+
+def status_badge(status: str) -> str:
+    return _BADGES.get(status) or _BADGES.get(status.lower()) or _render_badge(status, "bg-gray-500")
 
 LOCAL_TZ = ZoneInfo("America/New_York")
 
@@ -222,14 +292,54 @@ def local_time(value):
     return dt.astimezone(LOCAL_TZ).strftime("%Y-%m-%d %I:%M %p")
     
 templates.env.filters["local_time"] = local_time
+
+# Page templates are compiled once here (after the filters they use are
+# registered) and rendered straight into an HTMLResponse.
+_PAGE_TEMPLATES = {
+    name: templates.get_template(name)
+    for name in (
+        "code_ideas.html",
+        "conversation_detail.html",
+        "conversations.html",
+        "image_prompts.html",
+        "jobs.html",
+        "login.html",
+    )
+}
+
+def render(name: str, request: Request, **context) -> HTMLResponse:
+    if templates.env.auto_reload:
+        template = templates.get_template(name)
+    else:
+        template = _PAGE_TEMPLATES[name]
+    context.setdefault("now", lambda: datetime.now(LOCAL_TZ))
+    return HTMLResponse(template.render(request=request, **context))
+
+# Pages with no per-request data only vary by root_path and the footer year,
+# so each is rendered once per key and served from the cached bytes.
+_STATIC_HTML = {}
+
+def render_static(name: str, request: Request) -> HTMLResponse:
+    if templates.env.auto_reload:
+        return render(name, request)
+    now = datetime.now(LOCAL_TZ)
+    key = (name, request.scope.get("root_path", ""), now.year)
+    body = _STATIC_HTML.get(key)
+    if body is None:
+        body = _PAGE_TEMPLATES[name].render(request=request, now=lambda: now).encode()
+        _STATIC_HTML[key] = body
+    return HTMLResponse(content=body)
+
 # ====================================================================
 # GET
 # ====================================================================
+# Handlers stay async but run all SQLite work via asyncio.to_thread: the
+# default executor's threads are reused, so each keeps its own long-lived
+# connections (see memory.get_db_connection) and the event loop never blocks.
 
 @app.get("/", response_class=HTMLResponse)
 async def chat_ui(request: Request):
-    require_login(request)
-    return templates.TemplateResponse("jobs.html", {"request": request, "now": lambda: datetime.now(LOCAL_TZ)})
+    return render_static("jobs.html", request)
 
 @app.get("/code-ideas", response_class=HTMLResponse)
 async def code_ideas_page(
@@ -239,9 +349,8 @@ async def code_ideas_page(
     difficulty: Optional[str] = None,
     search: Optional[str] = None,
 ):
-    require_login(request)
-
-    ideas = list_code_ideas(
+    ideas = await asyncio.to_thread(
+        list_code_ideas,
         limit=300,
         status=status,
         language=language,
@@ -249,24 +358,19 @@ async def code_ideas_page(
         search=search,
     )
 
-    return templates.TemplateResponse(
+    return render(
         "code_ideas.html",
-        {
-            "request": request,
-            "ideas": ideas,
-            "status": status or "",
-            "language": language or "",
-            "difficulty": difficulty or "",
-            "search": search or "",
-            "now": lambda: datetime.now(LOCAL_TZ),
-        },
+        request,
+        ideas=ideas,
+        status=status or "",
+        language=language or "",
+        difficulty=difficulty or "",
+        search=search or "",
     )
 
 @app.get("/code-ideas/file/{idea_id}")
 async def code_idea_file(request: Request, idea_id: int):
-    require_login(request)
-
-    idea = get_code_idea(idea_id)
+    idea = await asyncio.to_thread(get_code_idea, idea_id)
     if not idea or not idea.get("generated_path"):
         raise HTTPException(status_code=404, detail="Generated file not found.")
 
@@ -288,69 +392,68 @@ async def code_idea_file(request: Request, idea_id: int):
 
 @app.get("/conversations", response_class=HTMLResponse)
 async def conversations_page(request: Request):
-    require_login(request)
-    convos = list_conversations()
-    return templates.TemplateResponse(
-        "conversations.html",
-        {"request": request, "conversations": convos, "now": lambda: datetime.now(LOCAL_TZ)},
-    )
+    convos = await asyncio.to_thread(list_conversations)
+    return render("conversations.html", request, conversations=convos)
 
 @app.get("/conversations/{conversation_id}", response_class=HTMLResponse)
 async def conversation_detail(request: Request, conversation_id: str):
-    require_login(request)
-    ensure_conversation(conversation_id)
-    messages = get_conversation_messages(conversation_id)
-    jobs = list_jobs(conversation_id=conversation_id, limit=50)
-    last_used_model = last_model_for_conversation(conversation_id)
-    last_system_prompt = last_system_for_conversation(conversation_id)
-    return templates.TemplateResponse(
+    # All four are independent (the reads don't need the row ensure_conversation
+    # may create), so they run as one concurrent round on the executor threads.
+    _, messages, jobs, (last_used_model, last_system_prompt) = await asyncio.gather(
+        asyncio.to_thread(ensure_conversation, conversation_id),
+        asyncio.to_thread(get_conversation_messages, conversation_id),
+        asyncio.to_thread(list_job_summaries, conversation_id=conversation_id, limit=50),
+        asyncio.to_thread(last_model_and_system, conversation_id),
+    )
+    return render(
         "conversation_detail.html",
-        {
-            "request": request,
-            "conversation_id": conversation_id,
-            "messages": messages,
-            "jobs": jobs,
-            "last_used_model": last_used_model,
-            "last_system_prompt": last_system_prompt,
-            "now": lambda: datetime.now(LOCAL_TZ),
-        },
+        request,
+        conversation_id=conversation_id,
+        messages=messages,
+        jobs=jobs,
+        last_used_model=last_used_model,
+        last_system_prompt=last_system_prompt,
     )
 
 @app.get("/image-prompts", response_class=HTMLResponse)
 async def image_prompts_page(request: Request):
-    require_login(request)
-    return templates.TemplateResponse("image_prompts.html", {"request": request, "now": lambda: datetime.now(LOCAL_TZ)})
+    return render_static("image_prompts.html", request)
 
 @app.get("/jobs", response_class=HTMLResponse)
 async def jobs_ui(request: Request):
-    require_login(request)
-    return templates.TemplateResponse("jobs.html", {"request": request, "now": lambda: datetime.now(LOCAL_TZ)})
+    return render_static("jobs.html", request)
 
-@app.get("/jobs/rows", response_class=HTMLResponse)
-async def jobs_rows(request: Request, status: Optional[str] = None, limit: int = 100):
-    # Protect this HTML fragment behind session login
-    require_login(request)
-    rows = list_jobs(status=status, limit=limit)
-    html = []
-    for j in rows:
-        badge = status_badge(j["status"])
-        html.append(
-            f"""
+_JOB_ROW = """
           <tr>
-            <td>{j['id']}</td>
-            <td>{j['conversation_id']}</td>
-            <td>{j['model']}</td>
+            <td>{id}</td>
+            <td>{conversation_id}</td>
+            <td>{model}</td>
             <td>{badge}</td>
-            <td>{local_time(j.get('created_at'))}</td>
-            <td><button class="underline text-sm" onclick="viewJob({j['id']})">View</button></td>
+            <td>{created_at}</td>
+            <td><button class="underline text-sm" onclick="viewJob({id})">View</button></td>
           </tr>
         """
+
+@app.get("/jobs/rows", response_class=HTMLResponse)
+async def jobs_rows(request: Request, status: Optional[str] = None, limit: int = Query(100, ge=1, le=MAX_JOB_ROWS)):
+    rows = await asyncio.to_thread(list_job_summaries, status=status, limit=limit)
+    # Returned as a Response so FastAPI doesn't run the str through its
+    # serializer before wrapping it.
+    return HTMLResponse("\n".join(
+        _JOB_ROW.format(
+            id=j["id"],
+            conversation_id=j["conversation_id"],
+            model=j["model"],
+            badge=status_badge(j["status"]),
+            created_at=local_time(j.get("created_at")),
         )
-    return "\n".join(html)
+        for j in rows
+    ))
 
+# login_post's error path still goes through render().
 @app.get("/login", response_class=HTMLResponse)
 async def login_get(request: Request):
-    return templates.TemplateResponse("login.html", {"request": request, "now": lambda: datetime.now(LOCAL_TZ)})
+    return render_static("login.html", request)
 
 @app.get("/logout")
 async def logout(request: Request):
@@ -359,57 +462,67 @@ async def logout(request: Request):
 
 # -------------------- Protected API (token required) --------------------
 
-# Full conversation thread
+def _not_modified(request: Request, etag: str) -> bool:
+    tags = request.headers.get("if-none-match")
+    if not tags:
+        return False
+    return any(t.strip().removeprefix("W/") == etag for t in tags.split(","))
+
+# Full conversation thread. The list endpoints return ORJSONResponse directly
+# so FastAPI skips its jsonable_encoder walk over every row.
 @app.get("/api/conversations/{conversation_id}/messages", dependencies=[Depends(require_api_auth)])
-async def get_conversation(conversation_id: str):
-    return {"messages": get_conversation_messages(conversation_id)}
+async def get_conversation(conversation_id: str, request: Request):
+    # Pollers re-send the ETag; an unchanged thread costs one index lookup.
+    count, last_id = await asyncio.to_thread(conversation_version, conversation_id)
+    etag = f'"m{count}-{last_id or 0}"'
+    if _not_modified(request, etag):
+        return Response(status_code=304, headers={"etag": etag})
+    messages = await asyncio.to_thread(get_conversation_messages, conversation_id)
+    return ORJSONResponse({"messages": messages}, headers={"etag": etag})
 
 # Latest assistant/user message + last job (handy for polling)
 @app.get("/api/conversations/{conversation_id}/latest", dependencies=[Depends(require_api_auth)])
 async def get_latest(conversation_id: str):
-    msgs = get_conversation_messages(conversation_id) or []
-    last_user = next((m for m in reversed(msgs) if m.get("role") == "user"), None)
-    last_assistant = next((m for m in reversed(msgs) if m.get("role") == "assistant"), None)
-    jobs = list_jobs(conversation_id=conversation_id, limit=1) or []
+    # Three indexed LIMIT 1 lookups instead of loading the whole history.
+    user, assistant, jobs = await asyncio.gather(
+        asyncio.to_thread(last_message_content, conversation_id, "user"),
+        asyncio.to_thread(last_message_content, conversation_id, "assistant"),
+        asyncio.to_thread(list_jobs, conversation_id=conversation_id, limit=1),
+    )
+    last_user = {"role": "user", "content": user} if user is not None else None
+    last_assistant = {"role": "assistant", "content": assistant} if assistant is not None else None
     last_job = jobs[0] if jobs else None
     return {"last_user": last_user, "last_assistant": last_assistant, "last_job": last_job}
 
 # Back-compat: previous simple status shape
 @app.get("/api/status/{conversation_id}", dependencies=[Depends(require_api_auth)])
 async def check_status(conversation_id: str):
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute(
-        """
-        SELECT content
-        FROM messages
-        WHERE conversation_id = ? AND role = 'assistant'
-        ORDER BY timestamp DESC
-        LIMIT 1
-    """,
-        (conversation_id,),
-    )
-    row = c.fetchone()
-    conn.close()
-    return {"response": row[0] if row else None}
+    return {"response": await asyncio.to_thread(latest_assistant_content, conversation_id)}
 
 # List jobs (optionally by status/conversation)
 @app.get("/api/jobs", dependencies=[Depends(require_api_auth)])
 async def list_jobs_api(
     status: Optional[str] = None,
     conversation_id: Optional[str] = None,
-    limit: int = 100,
+    limit: int = Query(100, ge=1, le=MAX_JOB_ROWS),
 ):
-    jobs = list_jobs(conversation_id=conversation_id, status=status, limit=limit)
-    return {"jobs": jobs}
+    jobs = await asyncio.to_thread(list_jobs, conversation_id=conversation_id, status=status, limit=limit)
+    return ORJSONResponse({"jobs": jobs})
 
 # Single job details
 @app.get("/api/jobs/{job_id}", dependencies=[Depends(require_api_auth)])
-async def get_job_api(job_id: int):
-    job = get_job(job_id)
+async def get_job_api(job_id: int, request: Request):
+    job = await asyncio.to_thread(get_job, job_id)
     if not job:
         raise HTTPException(status_code=404, detail="Job not found")
-    return job
+    # Finished jobs never change again, so they get a validator; queued and
+    # processing ones (partial results) are always sent in full.
+    if job["status"] not in ("done", "error"):
+        return ORJSONResponse(job)
+    etag = f'"j{job_id}-{job["status"]}-{job["processed_at"]}"'
+    if _not_modified(request, etag):
+        return Response(status_code=304, headers={"etag": etag})
+    return ORJSONResponse(job, headers={"etag": etag})
 
 # ====================================================================
 # POST (Protected API)
@@ -418,28 +531,25 @@ async def get_job_api(job_id: int):
 # Reply within an existing conversation
 @app.post("/api/conversations/{conversation_id}/reply", dependencies=[Depends(require_api_auth)])
 async def reply_conversation(conversation_id: str, body: ReplyRequest):
-    msgs = get_conversation_messages(conversation_id)
-    if body.system_prompt:
-        if not msgs or not any(m.get("role") == "system" for m in msgs):
-            add_message(conversation_id, "system", body.system_prompt)
-    if body.assistant_context:
-        add_message(conversation_id, "assistant", body.assistant_context)
-    add_message(conversation_id, "user", body.content)
-    job_id = queue_prompt(conversation_id, body.content, body.model, body.system_prompt, body.grammar_name)
+    return await asyncio.to_thread(_reply_conversation, conversation_id, body)
+
+def _reply_conversation(conversation_id: str, body: ReplyRequest):
+    job_id = enqueue_turn(
+        conversation_id, body.content, body.model, body.system_prompt, body.grammar_name,
+        assistant_context=body.assistant_context, system_once=True,
+    )
     return {"ok": True, "queued": True, "job_id": job_id, "conversation_id": conversation_id, "created_new": False, "model": body.model}
 
 # Create-or-continue conversation and (optionally) enqueue work
 @app.post("/api/jobs", dependencies=[Depends(require_api_auth)])
-async def create_job(payload: dict = Body(...)):
-    content = (payload.get("content") or "").strip()
-    model = (payload.get("model") or "mistral").strip()
-    system_prompt = (payload.get("system_prompt") or "").strip()
-    assistant_context = (payload.get("assistant_context") or "").strip()
-    conv_id_raw = (payload.get("conversation_id") or "").strip()
-    grammar_name = (payload.get("grammar_name") or "").strip() or None
+async def create_job(body: CreateJobRequest):
+    if not body.content and not body.system_prompt:
+        return ORJSONResponse({"error": "content or system_prompt is required"}, status_code=400)
+    return await asyncio.to_thread(_create_job, body)
 
-    if not content and not system_prompt:
-        return JSONResponse({"error": "content or system_prompt is required"}, status_code=400)
+def _create_job(body: CreateJobRequest):
+    content, model, system_prompt = body.content, body.model, body.system_prompt
+    conv_id_raw = body.conversation_id
 
     title_seed = (content or system_prompt)[:60]
     if conv_id_raw:
@@ -451,16 +561,11 @@ async def create_job(payload: dict = Body(...)):
 
     job_id = None
     if content:
-        if assistant_context:
-            # Manual ordering: system → assistant → user
-            if system_prompt:
-                add_message(conversation_id, "system", system_prompt)
-            add_message(conversation_id, "assistant", assistant_context)
-            add_message(conversation_id, "user", content)
-            job_id = queue_prompt(conversation_id, content, model, system_prompt, grammar_name)
-        else:
-            # Legacy path (no assistant_context): use existing helper
-            job_id = enqueue_user_message(conversation_id, content, model, system_prompt, grammar_name)
+        # Ordering: system → assistant → user, one transaction
+        job_id = enqueue_turn(
+            conversation_id, content, model, system_prompt, body.grammar_name,
+            assistant_context=body.assistant_context,
+        )
 
     return {
         "ok": True,
@@ -471,6 +576,32 @@ async def create_job(payload: dict = Body(...)):
         "model": model,
     }
 
+# Static parts of the image-prompt request, built once; the handler only
+# fills in the count and subject.
+_IMAGE_PROMPT_HEAD = (
+    'Generate {n} photo-realistic Flux image prompt{plural} about: "{subject}".\n\n'
+    "Each should start with 'Photo of...'.\n"
+    "Each should end with 'Resolution: 8K Aspect Ratio: 9:16 (portrait) Rendering: Ultra-detailed, high dynamic range'.\n"
+)
+
+_IMAGE_PROMPT_SOCIAL = (
+    "\n\nAfter the image prompts, generate a single social media title, a single group description, and exactly two (2) short, original hashtags to group all images together in a TikTok/Instagram post.\n\n"
+    "STYLE & RULES (must follow all):\n"
+    "- Voice: punchy, cinematic, vivid; avoid bland phrasing.\n"
+    "- Be specific: include 2–3 concrete visual details (props, materials, lighting, era, environment).\n"
+    "- Hook: imply motion or drama; use active verbs.\n"
+    "- No clichés or filler like 'explore the world of…', 'step into…', 'journey through…', 'discover…'.\n"
+    "- No generic terms like 'illustrations', 'collection', 'gallery'. Use subject nouns instead (e.g., 'airship corsets', 'soot-streaked goggles').\n"
+    "- Length: Title ≤ 70 characters. Description 1–2 sentences, 22–45 words.\n"
+    "- Tone: sensational but classy (no clickbait words like “shocking”, “insane”).\n"
+    "- Hashtags: exactly two custom tags; 1–3 words each; no spaces; no repeats of #fbn #ai #aiart; avoid broad tags like #steampunk, #art, #fantasy unless uniquely combined (e.g., #ValveVelvet).\n"
+    "- Do not mention resolution, camera brands, or 'AI'.\n\n"
+    "Format it like this at the end, exactly:\n\n"
+    "Social Media Title: <title>\n"
+    "Group Description: <description>\n"
+    "Hashtags: #fbn #ai #aiart <hashtag1> <hashtag2>\n"
+)
+
 @app.post("/image-prompts")
 async def submit_image_prompt(
     request: Request,
@@ -481,9 +612,8 @@ async def submit_image_prompt(
     count: Optional[int] = Form(None),
     title_desc: Optional[str] = Form(None),
 ):
-    require_login(request)
-
-    if not subject.strip():
+    subject = subject.strip()
+    if not subject:
         raise HTTPException(status_code=400, detail="Subject is required.")
 
     # If "multi" is checked, use count or default to 5
@@ -492,30 +622,12 @@ async def submit_image_prompt(
     else:
         n = 1
 
-    prompt = f"Generate {n} photo-realistic Flux image prompt{'s' if n > 1 else ''} about: \"{subject.strip()}\".\n\n"
-    prompt += "Each should start with 'Photo of...'.\n"
-    prompt += "Each should end with 'Resolution: 8K Aspect Ratio: 9:16 (portrait) Rendering: Ultra-detailed, high dynamic range'.\n"
+    prompt = _IMAGE_PROMPT_HEAD.format(n=n, plural="s" if n > 1 else "", subject=subject)
     if title_desc:
-        prompt += (
-            "\n\nAfter the image prompts, generate a single social media title, a single group description, and exactly two (2) short, original hashtags to group all images together in a TikTok/Instagram post.\n\n"
-            "STYLE & RULES (must follow all):\n"
-            "- Voice: punchy, cinematic, vivid; avoid bland phrasing.\n"
-            "- Be specific: include 2–3 concrete visual details (props, materials, lighting, era, environment).\n"
-            "- Hook: imply motion or drama; use active verbs.\n"
-            "- No clichés or filler like 'explore the world of…', 'step into…', 'journey through…', 'discover…'.\n"
-            "- No generic terms like 'illustrations', 'collection', 'gallery'. Use subject nouns instead (e.g., 'airship corsets', 'soot-streaked goggles').\n"
-            "- Length: Title ≤ 70 characters. Description 1–2 sentences, 22–45 words.\n"
-            "- Tone: sensational but classy (no clickbait words like “shocking”, “insane”).\n"
-            "- Hashtags: exactly two custom tags; 1–3 words each; no spaces; no repeats of #fbn #ai #aiart; avoid broad tags like #steampunk, #art, #fantasy unless uniquely combined (e.g., #ValveVelvet).\n"
-            "- Do not mention resolution, camera brands, or 'AI'.\n\n"
-            "Format it like this at the end, exactly:\n\n"
-            "Social Media Title: <title>\n"
-            "Group Description: <description>\n"
-            "Hashtags: #fbn #ai #aiart <hashtag1> <hashtag2>\n"
-        )
+        prompt += _IMAGE_PROMPT_SOCIAL
 
-    convo_id = create_conversation(title=f"Image: {subject[:30]}")
-    enqueue_user_message(convo_id, prompt.strip(), model, system_prompt.strip())
+    convo_id = await asyncio.to_thread(create_conversation, title=f"Image: {subject[:30]}")
+    await asyncio.to_thread(enqueue_turn, convo_id, prompt.strip(), model, system_prompt.strip())
 
     return RedirectResponse(url="/chat/jobs", status_code=303)
 
@@ -531,18 +643,15 @@ async def conversation_reply(
     model: str = Form("mistral"),
     system_prompt: str = Form(""),
 ):
-    require_login(request)
-    job_id = enqueue_user_message(conversation_id, user_input, model, system_prompt)
+    await asyncio.to_thread(enqueue_turn, conversation_id, user_input, model, system_prompt)
     return RedirectResponse(
         url=f"{request.scope.get('root_path','')}/conversations/{conversation_id}", status_code=303
     )
 
 @app.post("/login", response_class=HTMLResponse)
 async def login_post(request: Request, password: str = Form(...)):
-    if verify_password(password):
+    if await verify_password(password):
         request.session["logged_in"] = True
         return RedirectResponse(url="/chat", status_code=303)
 
-    return templates.TemplateResponse(
-        "login.html", {"request": request, "error": "Invalid password", "now": lambda: datetime.now(LOCAL_TZ)}
-    )
+    return render("login.html", request, error="Invalid password")
@@ -1,11 +1,84 @@
 # memory.py
+import atexit
+import logging
 import os
+import queue
+import select
 import sqlite3
-from datetime import datetime
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from contextlib import contextmanager
+from functools import lru_cache
 from typing import Optional
 from uuid import uuid4
 
 DB_PATH = os.path.join(os.path.dirname(__file__), "memory.db")
+WAKE_FIFO = os.getenv("LLAMALITH_WAKE_FIFO", "/tmp/llamalith.wake")
+
+# Long-lived connections per thread. Never shared across threads, so
+# sqlite3's same-thread check stays on. Nothing forks after importing this
+# module (the worker is one process with a thread pool; uvicorn spawns fresh
+# interpreters), so no per-process bookkeeping is needed. Autocommit mode;
+# multi-statement writes use explicit BEGIN/COMMIT.
+_local = threading.local()
+
+def _cache_size_mb() -> int:
+    """Per-connection page cache: SQLITE_CACHE_MB, else 1/64 of the RAM
+    available at startup, kept within 16-128 MB (every thread has its own
+    connections, and the worker needs the rest for model weights)."""
+    if os.getenv("SQLITE_CACHE_MB"):
+        return int(os.getenv("SQLITE_CACHE_MB"))
+    try:
+        avail = os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (AttributeError, ValueError, OSError):
+        return 64
+    return min(128, max(16, avail // (64 << 20)))
+
+# Per-connection settings. journal_mode=WAL is persisted in the database file,
+# so init_db sets it once instead of every new connection re-issuing it.
+_PRAGMAS = (
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=268435456",
+    f"PRAGMA cache_size=-{_cache_size_mb() * 1024}",
+)
+
+def _thread_connection(attr: str, *extra_pragmas):
+    conn = getattr(_local, attr, None)
+    if conn is not None:
+        return conn
+    conn = sqlite3.connect(DB_PATH, isolation_level=None)
+    for pragma in _PRAGMAS + extra_pragmas:
+        conn.execute(pragma)
+    setattr(_local, attr, conn)
+    return conn
+
+def get_db_connection():
+    """This thread's read-write connection."""
+    return _thread_connection("conn")
+
+def get_read_connection():
+    """This thread's read-only connection (query_only). Pure reads go here so
+    they never share a handle with an open write transaction; under WAL they
+    run alongside the writer instead of queueing behind it."""
+    return _thread_connection("ro", "PRAGMA query_only=1")
+
+@contextmanager
+def transaction(mode: str = ""):
+    """BEGIN/COMMIT around a block (ROLLBACK on error); yields the connection."""
+    conn = get_db_connection()
+    conn.execute(f"BEGIN {mode}")
+    try:
+        yield conn
+        conn.execute("COMMIT")
+    except BaseException:
+        # Also covers a failed COMMIT (SQLITE_BUSY, disk full), which leaves the
+        # transaction open; SQLite may already have rolled back on its own.
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
 
 # --- add near top (after DB_PATH etc.) ---
 def _ensure_column(conn, table: str, column: str, decl: str):
@@ -14,11 +87,30 @@ def _ensure_column(conn, table: str, column: str, decl: str):
     cols = {row[1] for row in c.fetchall()}
     if column not in cols:
         c.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
-        conn.commit()
+
+# Bump when the DDL below changes. The database records the version it was
+# built at (PRAGMA user_version), so imports of an up-to-date file skip the
+# whole bootstrap instead of re-running every CREATE/ALTER/DROP.
+_SCHEMA_VERSION = 3
+_init_lock = threading.Lock()
+_initialized = False
 
 def init_db():
-    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+    global _initialized
+    with _init_lock:
+        if _initialized:
+            return
+        conn = get_db_connection()
+        if conn.execute("PRAGMA user_version").fetchone()[0] < _SCHEMA_VERSION:
+            _create_schema(conn)
+            conn.execute(f"PRAGMA user_version={_SCHEMA_VERSION}")
+        # Refresh planner stats where they are missing or stale (cheap no-op otherwise).
+        conn.execute("PRAGMA optimize")
+        _initialized = True
+
+def _create_schema(conn):
     c = conn.cursor()
+    c.execute("PRAGMA journal_mode=WAL")
 
     # Conversations: id is TEXT (UUID)
     c.execute("""
@@ -56,222 +148,507 @@ def init_db():
     """)
 
     _ensure_column(conn, "chat_queue", "grammar_name", "TEXT")
-    
-    conn.commit()
-    conn.close()
+
+    # Worker poll (status='queued' ORDER BY created_at) and per-conversation
+    # job lists / last model.
+    c.execute("CREATE INDEX IF NOT EXISTS idx_queue_status_created ON chat_queue(status, created_at)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_queue_convo_created ON chat_queue(conversation_id, created_at)")
+    # "Last job's model" walks a conversation's jobs by id DESC. Partial and
+    # covering: only rows with a model, and model itself is in the index, so
+    # the lookup is one seek with no table access or temp b-tree sort.
+    c.execute("DROP INDEX IF EXISTS idx_queue_convo_id")
+    c.execute("""
+        CREATE INDEX IF NOT EXISTS idx_queue_convo_model ON chat_queue(conversation_id, id, model)
+        WHERE model IS NOT NULL AND TRIM(model) != ''
+    """)
+    # Ascending (..., timestamp) + the implicit rowid matches both
+    # "ORDER BY timestamp, id" (history) and, scanned backwards,
+    # "ORDER BY timestamp DESC, id DESC LIMIT 1" (latest by role) with no
+    # temp b-tree sort. Replaces the earlier DESC index, which still sorted ties.
+    c.execute("DROP INDEX IF EXISTS idx_msg_convo_role_ts")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_msg_convo_role_time ON messages(conversation_id, role, timestamp)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_msg_convo_time ON messages(conversation_id, timestamp)")
 
 init_db()
 
-def get_db_connection():
-    return sqlite3.connect(DB_PATH, check_same_thread=False)
+# --- Write-behind ---
+# Groups of statements queued here are applied by a background thread, up to
+# _WB_MAX_BATCH groups per transaction or after _WB_MAX_DELAY seconds, so a
+# burst of writes shares one commit. Each group lands atomically; a group
+# that still fails on its own runs its on_failure callback instead.
+_WB_MAX_BATCH = 8
+_WB_MAX_DELAY = 0.05
+_wb_queue: "queue.Queue[tuple]" = queue.Queue()
+_wb_thread: Optional[threading.Thread] = None
+_wb_start_lock = threading.Lock()
+
+def _apply_groups(groups):
+    with transaction() as conn:
+        for statements, _ in groups:
+            for sql, params in statements:
+                conn.execute(sql, params)
+
+def _wb_run():
+    while True:
+        batch = [_wb_queue.get()]
+        deadline = time.monotonic() + _WB_MAX_DELAY
+        while len(batch) < _WB_MAX_BATCH:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(_wb_queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        try:
+            _apply_groups(batch)
+        except Exception:
+            # Retry one by one so a single bad group can't sink the others.
+            for group in batch:
+                try:
+                    _apply_groups([group])
+                except Exception:
+                    # Params carry whole replies; log only the statements.
+                    statements, on_failure = group
+                    logging.exception(
+                        "write-behind group failed: %s", [sql.split(None, 2)[:2] for sql, _ in statements]
+                    )
+                    if on_failure is not None:
+                        try:
+                            on_failure()
+                        except Exception:
+                            logging.exception("write-behind on_failure callback failed")
+        finally:
+            for _ in batch:
+                _wb_queue.task_done()
+
+def write_behind(statements, on_failure=None):
+    """Queue [(sql, params), ...] to be applied atomically in the background.
+    on_failure() runs (on the writer thread) if the group can't be applied."""
+    global _wb_thread
+    if _wb_thread is None:
+        # Exactly one writer: flush_writes() and the group order rely on it.
+        with _wb_start_lock:
+            if _wb_thread is None:
+                t = threading.Thread(target=_wb_run, name="db-write-behind", daemon=True)
+                t.start()
+                _wb_thread = t
+    _wb_queue.put((statements, on_failure))
+
+def flush_writes():
+    """Block until every queued write-behind group has been applied."""
+    _wb_queue.join()
+
+atexit.register(flush_writes)
 
 # --- Conversation Operations ---
+# Conversations are never deleted, so once an id is known to exist it stays
+# that way; remember recent ones and skip the lookup on every page/POST.
+_KNOWN_CONVERSATIONS_MAX = 10_000
+_known_conversations: "OrderedDict[str, None]" = OrderedDict()
+_known_lock = threading.Lock()
+
 def ensure_conversation(conversation_id: str, title: str = "") -> str:
     """Create the conversation if it doesn't exist. Return conversation_id."""
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute("SELECT 1 FROM conversations WHERE id = ?", (conversation_id,))
-    exists = c.fetchone()
-    if not exists:
-        c.execute(
-            "INSERT INTO conversations (id, title) VALUES (?, ?)",
-            (conversation_id, title or "New Conversation")
-        )
-        conn.commit()
-    conn.close()
+    with _known_lock:
+        if conversation_id in _known_conversations:
+            _known_conversations.move_to_end(conversation_id)
+            return conversation_id
+    # id is the primary key: one statement, a no-op when the row exists.
+    get_db_connection().execute(
+        "INSERT OR IGNORE INTO conversations (id, title) VALUES (?, ?)",
+        (conversation_id, title or "New Conversation")
+    )
+    _remember_conversation(conversation_id)
     return conversation_id
 
+def _remember_conversation(conversation_id: str):
+    with _known_lock:
+        _known_conversations[conversation_id] = None
+        if len(_known_conversations) > _KNOWN_CONVERSATIONS_MAX:
+            _known_conversations.popitem(last=False)
+
 def create_conversation(title: str = "") -> str:
     """Create a brand new conversation with a generated UUID."""
+    # A fresh uuid4 can't collide: plain INSERT, no existence check, and the
+    # id goes straight into the known set for the enqueue that follows.
     cid = str(uuid4())
-    ensure_conversation(cid, title=title)
+    get_db_connection().execute(
+        "INSERT INTO conversations (id, title) VALUES (?, ?)",
+        (cid, title or "New Conversation")
+    )
+    _remember_conversation(cid)
     return cid
 
 def list_conversations():
-    conn = get_db_connection()
+    conn = get_read_connection()
     c = conn.cursor()
     c.execute("SELECT id, title, created_at FROM conversations ORDER BY created_at DESC")
     conversations = c.fetchall()
-    conn.close()
     return conversations
 
 # --- Message Memory Operations ---
-def add_message(conversation_id: str, role: str, content: str):
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute(
-        "INSERT INTO messages (conversation_id, role, content) VALUES (?, ?, ?)",
-        (conversation_id, role, content)
-    )
-    conn.commit()
-    conn.close()
+def conversation_version(conversation_id: str) -> tuple:
+    """(message count, newest message id); messages are append-only, so this
+    changes whenever get_conversation_messages() would. Index-only lookup."""
+    return get_read_connection().execute(
+        "SELECT COUNT(*), MAX(id) FROM messages WHERE conversation_id = ?",
+        (conversation_id,)
+    ).fetchone()
+
+# Recently read histories, keyed by conversation and validated against
+# conversation_version() on every hit, so writes from the worker process are
+# seen too. The version is read before the rows: a history that raced with an
+# insert is stored under the older version and simply reloaded next time.
+_HISTORY_CACHE_MAX = 256
+_history_cache: "OrderedDict[str, tuple]" = OrderedDict()
+_history_lock = threading.Lock()
 
 def get_conversation_messages(conversation_id: str):
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute(
-        "SELECT role, content FROM messages WHERE conversation_id = ? ORDER BY timestamp",
+    # Plain dicts (not sqlite3.Row): callers use .get(), append to the list and
+    # JSON-encode it. Callers get their own list; the dicts are shared and
+    # must not be mutated.
+    version = conversation_version(conversation_id)
+    with _history_lock:
+        cached = _history_cache.get(conversation_id)
+        if cached is not None and cached[0] == version:
+            _history_cache.move_to_end(conversation_id)
+            return list(cached[1])
+    cur = get_read_connection().execute(
+        "SELECT role, content FROM messages WHERE conversation_id = ? ORDER BY timestamp, id",
         (conversation_id,)
     )
-    rows = c.fetchall()
-    conn.close()
-    return [{"role": role, "content": content} for role, content in rows]
+    messages = [{"role": role, "content": content} for role, content in cur]
+    with _history_lock:
+        _history_cache[conversation_id] = (version, messages)
+        _history_cache.move_to_end(conversation_id)
+        if len(_history_cache) > _HISTORY_CACHE_MAX:
+            _history_cache.popitem(last=False)
+    return list(messages)
 
 # --- Queue Operations ---
-def queue_prompt(conversation_id: str, user_input: str, model: str, system_prompt: str, grammar_name: str = None):
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute("""
+def _insert_queue_row(conn, conversation_id, user_input, model, system_prompt, grammar_name) -> int:
+    row = conn.execute("""
         INSERT INTO chat_queue (conversation_id, user_input, model, system_prompt, grammar_name)
         VALUES (?, ?, ?, ?, ?)
-    """, (conversation_id, user_input, model, system_prompt, (grammar_name or "").strip() or None))
-    queue_id = c.lastrowid
-    conn.commit()
-    conn.close()
-    return queue_id
+        RETURNING id
+    """, (conversation_id, user_input, model, system_prompt, (grammar_name or "").strip() or None)).fetchone()
+    return row[0]
 
-def claim_next_job():
-    conn = get_db_connection()
-    conn.isolation_level = None
-    c = conn.cursor()
+# Rows per multi-row INSERT; 3 parameters each keeps us under SQLite's
+# default 999 host-parameter limit.
+_INSERT_CHUNK = 300
+
+@lru_cache(maxsize=None)
+def _sql_insert_messages(n: int) -> str:
+    return "INSERT INTO messages (conversation_id, role, content) VALUES " + ", ".join(["(?, ?, ?)"] * n)
+
+def _insert_messages(conn, conversation_id: str, rows):
+    """Insert (role, content) rows in order, as one multi-row VALUES statement
+    per chunk. Caller owns the transaction."""
+    for start in range(0, len(rows), _INSERT_CHUNK):
+        chunk = rows[start:start + _INSERT_CHUNK]
+        params = [v for role, content in chunk for v in (conversation_id, role, content)]
+        conn.execute(_sql_insert_messages(len(chunk)), params)
+
+_SQL_ADD_SYSTEM_ONCE = """
+    INSERT INTO messages (conversation_id, role, content)
+    SELECT :cid, 'system', :text
+    WHERE NOT EXISTS (SELECT 1 FROM messages WHERE conversation_id = :cid AND role = 'system')
+"""
+
+def _insert_turn(conn, conversation_id, content, model, system_prompt, grammar_name,
+                 assistant_context, system_once) -> int:
+    rows = []
+    if system_prompt:
+        if system_once:
+            conn.execute(_SQL_ADD_SYSTEM_ONCE, {"cid": conversation_id, "text": system_prompt})
+        else:
+            rows.append(("system", system_prompt))
+    if assistant_context:
+        rows.append(("assistant", assistant_context))
+    rows.append(("user", content))
+    _insert_messages(conn, conversation_id, rows)
+    return _insert_queue_row(conn, conversation_id, content, model, system_prompt, grammar_name)
+
+# Group commit: concurrent enqueue_turn calls share one transaction. Whoever
+# holds _turn_commit_lock drains every pending turn, so a burst of N turns
+# costs one BEGIN/COMMIT, while a lone call commits straight away.
+_turn_pending: list = []
+_turn_pending_lock = threading.Lock()
+_turn_commit_lock = threading.Lock()
+
+def _commit_turns(batch):
     try:
-        c.execute("BEGIN IMMEDIATE")
-        c.execute("""
-            SELECT id, conversation_id, user_input, model, system_prompt, grammar_name
-            FROM chat_queue
-            WHERE status = 'queued'
-            ORDER BY created_at ASC
-            LIMIT 1
-        """)
-        row = c.fetchone()
-        if not row:
-            c.execute("COMMIT")
-            conn.close()
-            return None
-
-        job_id, convo_id, user_input, model, system_prompt, grammar_name = row
-        c.execute("UPDATE chat_queue SET status = 'processing' WHERE id = ?", (job_id,))
-        c.execute("COMMIT")
-        conn.close()
-        return {
-            "id": job_id,
-            "conversation_id": convo_id,
-            "user_input": user_input,
-            "model": model,
-            "system_prompt": system_prompt,
-            "grammar_name": grammar_name
-        }
-    except Exception:
-        c.execute("ROLLBACK")
-        conn.close()
-        raise
+        # IMMEDIATE: take the write lock up front, so a busy wait happens at
+        # BEGIN rather than between the inserts.
+        with transaction("IMMEDIATE") as conn:
+            job_ids = [_insert_turn(conn, *turn) for turn, _ in batch]
+    except Exception as e:
+        if len(batch) == 1:
+            batch[0][1].set_exception(e)
+        else:
+            # Retry one by one so a single bad turn can't sink the others.
+            for item in batch:
+                _commit_turns([item])
+        return
+    for (_, fut), job_id in zip(batch, job_ids):
+        fut.set_result(job_id)
+    notify_workers()
+
+def enqueue_turn(
+    conversation_id: str,
+    content: str,
+    model: str,
+    system_prompt: str = "",
+    grammar_name: str = None,
+    assistant_context: str = "",
+    system_once: bool = False,
+) -> int:
+    """Insert the (optional) system message, the (optional) assistant context,
+    the user message and the queue row in one transaction. With system_once the
+    system message is only added if the conversation has none yet. Returns the
+    new job id."""
+    fut = Future()
+    turn = (conversation_id, content, model, system_prompt, grammar_name, assistant_context, system_once)
+    with _turn_pending_lock:
+        _turn_pending.append((turn, fut))
+    with _turn_commit_lock:
+        with _turn_pending_lock:
+            batch = _turn_pending[:]
+            _turn_pending.clear()
+        if batch:
+            _commit_turns(batch)
+    return fut.result()
+
+# --- Worker wakeup ---
+# The queue_worker dispatcher blocks on a named pipe instead of polling; every
+# enqueue writes one byte to wake it.
+_wake_reader: Optional[int] = None
+_wake_warned = False
+
+def notify_workers():
+    global _wake_warned
+    try:
+        fd = os.open(WAKE_FIFO, os.O_WRONLY | os.O_NONBLOCK)
+    except OSError as e:
+        # No FIFO / no worker listening; workers fall back to the poll. Say so
+        # once: a FIFO that isn't shared (PrivateTmp, separate containers)
+        # otherwise silently turns every wakeup into a poll wait.
+        if not _wake_warned:
+            _wake_warned = True
+            logging.warning("can't open wakeup FIFO %s (%s); workers will poll", WAKE_FIFO, e)
+        return
+    try:
+        os.write(fd, b"1")
+    except BlockingIOError:
+        pass  # pipe full, plenty of wakeups already pending
+    finally:
+        os.close(fd)
+
+def wait_for_job(timeout: float):
+    """Block until notify_workers() fires or timeout elapses."""
+    global _wake_reader
+    fd = _wake_reader
+    if fd is None:
+        try:
+            os.mkfifo(WAKE_FIFO)
+        except FileExistsError:
+            pass
+        # O_RDWR keeps a writer attached so select() never spins on EOF.
+        fd = os.open(WAKE_FIFO, os.O_RDWR | os.O_NONBLOCK)
+        _wake_reader = fd
+    ready, _, _ = select.select([fd], [], [], timeout)
+    if ready:
+        # Drain every pending byte: the caller claims until the queue is empty,
+        # so a burst of enqueues should cost one wakeup, not one per job.
+        try:
+            os.read(fd, 4096)
+        except BlockingIOError:
+            pass  # another worker took this wakeup
+
+_SQL_CLAIM_RETURNING = "RETURNING id, conversation_id, user_input, model, system_prompt, grammar_name"
+
+def claim_next_job(prefer_models=(), max_wait_sec: int = 120):
+    """Atomically mark the next queued job 'processing' and return it.
+
+    With prefer_models (the worker's loaded, currently free models) jobs for those models go
+    first, so mixed-model queues don't force a weight swap per job; any job
+    older than max_wait_sec keeps plain FIFO priority so nothing starves."""
+    conn = get_db_connection()
+    # One UPDATE ... RETURNING (SQLite 3.35+): select and mark happen in a
+    # single autocommit write, so two workers can never pick the same row.
+    if prefer_models:
+        marks = ", ".join("?" * len(prefer_models))
+        row = conn.execute(f"""
+            UPDATE chat_queue SET status = 'processing'
+            WHERE id = (
+                SELECT id FROM chat_queue
+                WHERE status = 'queued'
+                ORDER BY
+                    CASE WHEN model IN ({marks}) OR created_at <= datetime('now', ?)
+                         THEN 0 ELSE 1 END,
+                    created_at ASC
+                LIMIT 1
+            )
+            {_SQL_CLAIM_RETURNING}
+        """, (*prefer_models, f"-{int(max_wait_sec)} seconds")).fetchone()
+    else:
+        row = conn.execute(f"""
+            UPDATE chat_queue SET status = 'processing'
+            WHERE id = (
+                SELECT id FROM chat_queue
+                WHERE status = 'queued'
+                ORDER BY created_at ASC
+                LIMIT 1
+            )
+            {_SQL_CLAIM_RETURNING}
+        """).fetchone()
+    if not row:
+        return None
+
+    job_id, convo_id, user_input, model, system_prompt, grammar_name = row
+    return {
+        "id": job_id,
+        "conversation_id": convo_id,
+        "user_input": user_input,
+        "model": model,
+        "system_prompt": system_prompt,
+        "grammar_name": grammar_name
+    }
+
+_SQL_JOB_PROGRESS = "UPDATE chat_queue SET result = ? WHERE id = ? AND status = 'processing'"
 
-def save_assistant_message(conversation_id: str, content: str):
-    add_message(conversation_id, "assistant", content)
+def update_job_progress(job_id: int, partial_text: str):
+    """Store partial model output while a job is still processing. Goes through
+    the write-behind batcher so the decode loop never waits on a commit; the
+    status guard makes a late update after finish/failure a no-op."""
+    write_behind([(_SQL_JOB_PROGRESS, (partial_text, job_id))])
 
 def mark_job_done(job_id: int, failed=False, result_text=None):
     conn = get_db_connection()
     c = conn.cursor()
     status = 'done' if not failed else 'error'
+    # SQLite stamps the UTC time itself (same ISO-8601 'T' shape as before).
     c.execute("""
         UPDATE chat_queue
-        SET status = ?, result = ?, processed_at = ?
+        SET status = ?, result = ?, processed_at = strftime('%Y-%m-%dT%H:%M:%f', 'now')
         WHERE id = ?
-    """, (status, result_text, datetime.utcnow().isoformat(), job_id))
-    conn.commit()
-    conn.close()
+    """, (status, result_text, job_id))
+
+_SQL_FINISH_MESSAGE = "INSERT INTO messages (conversation_id, role, content) VALUES (?, 'assistant', ?)"
+_SQL_FINISH_JOB = """
+    UPDATE chat_queue
+    SET status = 'done', result = ?, processed_at = strftime('%Y-%m-%dT%H:%M:%f', 'now')
+    WHERE id = ?
+"""
+
+def finish_job(job_id: int, conversation_id: str, reply: str):
+    """Save the assistant reply and mark the job done, via the write-behind
+    batcher (one commit for up to _WB_MAX_BATCH completions)."""
+    write_behind([
+        (_SQL_FINISH_MESSAGE, (conversation_id, reply)),
+        (_SQL_FINISH_JOB, (reply, job_id)),
+    ], on_failure=lambda: _finish_failed(job_id, reply))
+
+def _finish_failed(job_id: int, reply: str):
+    # The reply couldn't be saved as a message: don't leave the job stuck in
+    # 'processing'. Mark it failed, keeping the reply as its result if possible.
+    try:
+        mark_job_done(job_id, failed=True, result_text=reply)
+    except Exception:
+        mark_job_done(job_id, failed=True, result_text="Failed to save model reply")
 
 # --- Jobs (chat_queue) helpers ---
 
-def list_jobs(conversation_id: str = None, status: str = None, limit: int = 100):
-    conn = get_db_connection()
-    c = conn.cursor()
+_JOB_KEYS = (
+    "id", "conversation_id", "user_input", "model", "system_prompt",
+    "status", "result", "created_at", "processed_at",
+)
+# Listing pages only show these; leaving out user_input/system_prompt/result
+# keeps the big TEXT values out of the page cache and the rendered rows.
+_JOB_SUMMARY_KEYS = ("id", "conversation_id", "model", "status", "created_at", "processed_at")
 
+def _list_jobs_sql(keys, by_conversation: bool, by_status: bool) -> str:
     where = []
-    params = []
-
-    if conversation_id:
+    if by_conversation:
         where.append("conversation_id = ?")
-        params.append(conversation_id)
-    if status:
+    if by_status:
         where.append("status = ?")
-        params.append(status)
-
-    where_sql = ("WHERE " + " AND ".join(where)) if where else ""
-    c.execute(f"""
-        SELECT id, conversation_id, user_input, model, system_prompt, status, result, created_at, processed_at
-        FROM chat_queue
-        {where_sql}
-        ORDER BY created_at DESC
-        LIMIT ?
-    """, (*params, limit))
-
-    rows = c.fetchall()
-    conn.close()
-
-    return [
-        {
-            "id": r[0],
-            "conversation_id": r[1],
-            "user_input": r[2],
-            "model": r[3],
-            "system_prompt": r[4],
-            "status": r[5],
-            "result": r[6],
-            "created_at": r[7],
-            "processed_at": r[8],
-        }
-        for r in rows
-    ]
+    where_sql = (" WHERE " + " AND ".join(where)) if where else ""
+    return f"SELECT {', '.join(keys)} FROM chat_queue{where_sql} ORDER BY created_at DESC LIMIT ?"
+
+# One fixed SQL string per filter combination, built once, so every call hits
+# sqlite3's per-connection prepared-statement cache without formatting SQL.
+_SQL_LIST_JOBS = {
+    (c, s): _list_jobs_sql(_JOB_KEYS, c, s) for c in (False, True) for s in (False, True)
+}
+_SQL_LIST_JOB_SUMMARIES = {
+    (c, s): _list_jobs_sql(_JOB_SUMMARY_KEYS, c, s) for c in (False, True) for s in (False, True)
+}
+_SQL_GET_JOB = f"SELECT {', '.join(_JOB_KEYS)} FROM chat_queue WHERE id = ?"
+
+def list_jobs(conversation_id: str = None, status: str = None, limit: int = 100):
+    params = [p for p in (conversation_id, status) if p]
+    sql = _SQL_LIST_JOBS[bool(conversation_id), bool(status)]
+    cur = get_read_connection().execute(sql, (*params, limit))
+    return [dict(zip(_JOB_KEYS, r)) for r in cur]
+
+def list_job_summaries(conversation_id: str = None, status: str = None, limit: int = 100):
+    """list_jobs() without the prompt/result text, for the HTML listings."""
+    params = [p for p in (conversation_id, status) if p]
+    sql = _SQL_LIST_JOB_SUMMARIES[bool(conversation_id), bool(status)]
+    cur = get_read_connection().execute(sql, (*params, limit))
+    return [dict(zip(_JOB_SUMMARY_KEYS, r)) for r in cur]
 
 def get_job(job_id: int):
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute("""
-        SELECT id, conversation_id, user_input, model, system_prompt, status, result, created_at, processed_at
-        FROM chat_queue
-        WHERE id = ?
-    """, (job_id,))
-    r = c.fetchone()
-    conn.close()
-    if not r:
-        return None
-    return {
-        "id": r[0],
-        "conversation_id": r[1],
-        "user_input": r[2],
-        "model": r[3],
-        "system_prompt": r[4],
-        "status": r[5],
-        "result": r[6],
-        "created_at": r[7],
-        "processed_at": r[8],
-    }
+    r = get_read_connection().execute(_SQL_GET_JOB, (job_id,)).fetchone()
+    return dict(zip(_JOB_KEYS, r)) if r else None
 
-def last_model_for_conversation(conversation_id: str) -> Optional[str]:
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute("""
-        SELECT model
-        FROM chat_queue
-        WHERE conversation_id = ?
-          AND model IS NOT NULL AND TRIM(model) != ''
-        ORDER BY id DESC
-        LIMIT 1
-    """, (conversation_id,))
-    row = c.fetchone()
-    conn.close()
-    return row[0] if row else None
+def last_model_and_system(conversation_id: str):
+    """(last job's model, newest system message) for the conversation page, in
+    one round trip."""
+    return get_read_connection().execute("""
+        SELECT
+            (SELECT model FROM chat_queue
+             WHERE conversation_id = :cid
+               AND model IS NOT NULL AND TRIM(model) != ''
+             ORDER BY id DESC LIMIT 1),
+            (SELECT content FROM messages
+             WHERE conversation_id = :cid AND role = 'system'
+             ORDER BY timestamp DESC, id DESC LIMIT 1)
+    """, {"cid": conversation_id}).fetchone()
 
-def last_system_for_conversation(conversation_id: str):
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute("""
+def last_message_content(conversation_id: str, role: str) -> Optional[str]:
+    """Content of the newest message with this role (one idx_msg_convo_role_time probe)."""
+    row = get_read_connection().execute("""
         SELECT content FROM messages
-        WHERE conversation_id = ? AND role = 'system'
-        ORDER BY timestamp DESC
+        WHERE conversation_id = ? AND role = ?
+        ORDER BY timestamp DESC, id DESC
         LIMIT 1
-    """, (conversation_id,))
-    row = c.fetchone()
-    conn.close()
+    """, (conversation_id, role)).fetchone()
     return row[0] if row else None
+
+# Status polling hits the same few conversations over and over, so results are
+# memoised process-wide. Messages are only ever appended (AUTOINCREMENT ids),
+# so MAX(id) changes exactly when a message lands, from the API or the
+# worker; job progress writes to chat_queue don't flush the cache.
+_STATUS_CACHE_MAX = 1024
+_status_lock = threading.Lock()
+_status_mark = None
+_status_cache: dict = {}
+
+def latest_assistant_content(conversation_id: str) -> Optional[str]:
+    global _status_mark
+    mark = get_read_connection().execute("SELECT MAX(id) FROM messages").fetchone()[0]
+    with _status_lock:
+        if mark != _status_mark or len(_status_cache) >= _STATUS_CACHE_MAX:
+            _status_cache.clear()
+            _status_mark = mark
+        elif conversation_id in _status_cache:
+            return _status_cache[conversation_id]
+    content = last_message_content(conversation_id, "assistant")
+    with _status_lock:
+        if mark == _status_mark:
+            _status_cache[conversation_id] = content
+    return content
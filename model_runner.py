@@ -1,13 +1,33 @@
 import os
 import json
 import gc
+import hashlib
 import logging
 import re
-from typing import List, Dict, Any, Optional
+import threading
+import time
+from bisect import bisect_right
+from collections import OrderedDict
+from functools import lru_cache
+from itertools import accumulate
+from typing import List, Dict, Any, Callable, Iterable, Optional
 
-from llama_cpp import Llama, LlamaGrammar
+from llama_cpp import Llama, LlamaGrammar, LlamaRAMCache
 
 SAFETY_MARGIN = int(os.getenv("LLM_SAFETY_MARGIN", "128"))
+# When streaming, report partial output to the caller every N chunks.
+STREAM_FLUSH_EVERY = int(os.getenv("LLM_STREAM_FLUSH_EVERY", "16"))
+# Tokens kept free for the reply when trimming long histories to fit n_ctx.
+HISTORY_RESERVE = int(os.getenv("LLM_HISTORY_RESERVE", "256"))
+GRAMMAR_DIR = os.getenv("LLM_GRAMMAR_DIR", "/home/smithkt/llama.cpp/grammars")
+# How many models may stay loaded at once (least recently used is evicted).
+MAX_RESIDENT = max(1, int(os.getenv("LLM_MAX_RESIDENT", "1")))
+# RAM for saved KV states per model (0 = off). Llama already reuses the KV
+# prefix of the previous call; this keeps states of several conversations so
+# interleaved jobs still only prefill their new turn.
+PROMPT_CACHE_MB = int(os.getenv("LLM_PROMPT_CACHE_MB", "0"))
+# Unload a model nobody has used for this many seconds (0 = keep it).
+IDLE_TTL = float(os.getenv("LLM_IDLE_TTL", "0"))
 
 # ---------- config ----------
 CONFIG_PATH = os.getenv("LLAMALITH_CONFIG", "config.json")
@@ -67,32 +87,163 @@ print(f"[llamalith] model_paths={MODEL_PATHS}")
 print(f"[llamalith] model_formats={MODEL_FORMATS}")
 
 # ---------- model cache ----------
-# Keep only ONE model loaded at a time to avoid CPU/RAM exhaustion.
-_LOADED: Dict[str, Llama] = {}
+# At most MAX_RESIDENT models loaded (default ONE) to avoid CPU/RAM exhaustion.
+_LOADED: "OrderedDict[str, Llama]" = OrderedDict()
+# queue_worker runs jobs on threads; loading is serialised and each Llama
+# handle (not reentrant) is used by one thread at a time.
+_LOAD_LOCK = threading.Lock()
+_MODEL_LOCKS: Dict[str, threading.Lock] = {}
+_LAST_USED: Dict[str, float] = {}
+
+
+def _model_lock(model_key: str) -> threading.Lock:
+    # Keys come from client requests: check them before they get an entry
+    # here (or in _LAST_USED) that would never go away.
+    if model_key not in MODEL_PATHS:
+        raise ValueError(f"Unknown model '{model_key}'")
+    with _LOAD_LOCK:
+        return _MODEL_LOCKS.setdefault(model_key, threading.Lock())
+
+
+def _touch(model_key: str) -> None:
+    # Idle time counts from the end of the last job, not its start.
+    with _LOAD_LOCK:
+        if model_key in _LOADED:
+            _LAST_USED[model_key] = time.monotonic()
+
+
+def _available_cpus() -> int:
+    """CPUs this process may run on (honours taskset/cpuset and pin_cpus)."""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 8
+
+
+def _parse_cpulist(text: str) -> set:
+    """'0-3,8,10-11' -> {0, 1, 2, 3, 8, 10, 11} (sysfs/taskset list format)."""
+    cpus = set()
+    for part in text.strip().split(","):
+        if not part:
+            continue
+        lo, _, hi = part.partition("-")
+        cpus.update(range(int(lo), int(hi or lo) + 1))
+    return cpus
+
+
+def pin_cpus() -> None:
+    """Confine this process to LLM_CPU_LIST (e.g. one CCD: "0-7,64-71") or to
+    the CPUs of NUMA node LLM_NUMA_NODE, so decode reads weights from local
+    memory. Call from the main thread before loading models or starting
+    threads: affinity is per thread and inherited, and first-touch page
+    placement follows it."""
+
+    cpu_list = os.getenv("LLM_CPU_LIST")
+    node = os.getenv("LLM_NUMA_NODE")
+
+    try:
+        if cpu_list:
+            cpus = _parse_cpulist(cpu_list)
+        elif node:
+            with open(f"/sys/devices/system/node/node{int(node)}/cpulist", encoding="ascii") as f:
+                cpus = _parse_cpulist(f.read())
+        else:
+            return
+        os.sched_setaffinity(0, cpus)
+        print(f"[llamalith] pinned to cpus={sorted(cpus)}")
+    except (OSError, ValueError, AttributeError) as e:
+        logging.warning("[pin] cpu pinning skipped: %s", e)
 
 
 def _settings_for(model_key: str) -> Dict[str, Any]:
     return MODEL_SETTINGS.get(model_key, {}) or {}
 
 
-def _unload_all_models() -> None:
-    global _LOADED
+def _env_flag(name: str, default: bool = False) -> bool:
+    """Boolean env var: 1/true/yes/on (any case) is on; unset uses default."""
+    value = os.getenv(name)
+    if value is None or not value.strip():
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
 
-    if _LOADED:
-        print(f"[llamalith] unloading cached models: {list(_LOADED.keys())}")
 
-    _LOADED.clear()
+def _release(model_key: str, llm: Llama) -> None:
+    # Free the llama.cpp context and unmap the weights now rather than at some
+    # later GC, unless a job thread is still running on it (that thread's
+    # reference keeps it alive until it finishes). Called under _LOAD_LOCK.
+    lock = _MODEL_LOCKS.get(model_key)
+    if lock is not None and not lock.acquire(blocking=False):
+        return
+    try:
+        close = getattr(llm, "close", None)
+        if close is not None:
+            close()
+    finally:
+        if lock is not None:
+            lock.release()
+
+
+def _evict_for_load() -> None:
+    if len(_LOADED) < MAX_RESIDENT:
+        return
+    while len(_LOADED) >= MAX_RESIDENT:
+        model_key, llm = _LOADED.popitem(last=False)
+        _LAST_USED.pop(model_key, None)
+        print(f"[llamalith] unloading cached model: {model_key}")
+        _release(model_key, llm)
     gc.collect()
 
 
+def unload_idle() -> None:
+    """Unload models unused for LLM_IDLE_TTL seconds; the worker calls this
+    while it has nothing to do. Models busy with a job are left alone."""
+
+    if IDLE_TTL <= 0:
+        return
+    now = time.monotonic()
+    unloaded = False
+    with _LOAD_LOCK:
+        for model_key in list(_LOADED):
+            if now - _LAST_USED.get(model_key, now) < IDLE_TTL:
+                continue
+            lock = _MODEL_LOCKS.get(model_key)
+            if lock is not None and lock.locked():
+                continue
+            llm = _LOADED.pop(model_key)
+            _LAST_USED.pop(model_key, None)
+            print(f"[llamalith] unloading idle model: {model_key}")
+            _release(model_key, llm)
+            unloaded = True
+    if unloaded:
+        gc.collect()
+
+
+def free_resident_models() -> List[str]:
+    """Keys of the loaded models no job is running on, most recently used
+    last. A busy model's lock is held for the whole generation, so a job
+    claimed for it would only sit 'processing' until that one finishes."""
+    with _LOAD_LOCK:
+        return [
+            model_key for model_key in _LOADED
+            if not (model_key in _MODEL_LOCKS and _MODEL_LOCKS[model_key].locked())
+        ]
+
+
 def get_model(model_key: str) -> Llama:
-    """Load a model by key. Keeps only one model resident at a time."""
+    """Load a model by key. Keeps at most MAX_RESIDENT models resident."""
 
+    with _LOAD_LOCK:
+        return _load_model(model_key)
+
+
+def _load_model(model_key: str) -> Llama:
     if model_key in _LOADED:
+        _LAST_USED[model_key] = time.monotonic()
+        _LOADED.move_to_end(model_key)
         return _LOADED[model_key]
 
     # Important: avoid keeping mistral/mythomax/openchat/gemma4 all in RAM.
-    _unload_all_models()
+    _evict_for_load()
 
     path = MODEL_PATHS.get(model_key)
 
@@ -103,7 +254,7 @@ def get_model(model_key: str) -> Llama:
 
     s = _settings_for(model_key)
 
-    n_ctx = int(os.getenv("LLM_N_CTX", str(s.get("n_ctx", 4096))))
+    n_ctx = _sampling_preset(model_key)["n_ctx"]
 
     model_format = (
         os.getenv("LLM_CHAT_FORMAT")
@@ -111,13 +262,22 @@ def get_model(model_key: str) -> Llama:
         or "auto"
     )
 
+    n_batch = int(os.getenv("LLM_N_BATCH", str(s.get("n_batch", 512))))
+    cpus = _available_cpus()
+
     llama_kwargs = {
         "model_path": path,
         "n_ctx": n_ctx,
-        "n_threads": int(os.getenv("LLM_N_THREADS", str(os.cpu_count() or 8))),
-        "n_batch": int(os.getenv("LLM_N_BATCH", "512")),
+        # Prefill is compute-bound and uses every core; decode is bound by
+        # memory bandwidth and slows down past about half of them.
+        "n_threads": int(os.getenv("LLM_N_THREADS", str(max(1, cpus // 2)))),
+        "n_threads_batch": int(os.getenv("LLM_N_THREADS_BATCH", str(cpus))),
+        "n_batch": n_batch,
+        # Physical batch = logical batch so prefill runs as full-width GEMMs.
+        "n_ubatch": int(os.getenv("LLM_N_UBATCH", str(n_batch))),
         "use_mmap": True,
-        "use_mlock": False,
+        # Locks the mapped weights in RAM (costs their full file size).
+        "use_mlock": _env_flag("LLM_MLOCK", bool(s.get("use_mlock", False))),
         "verbose": bool(int(os.getenv("LLM_VERBOSE", "0"))),
     }
 
@@ -135,117 +295,191 @@ def get_model(model_key: str) -> Llama:
 
     llm = Llama(**llama_kwargs)
 
+    if PROMPT_CACHE_MB > 0:
+        llm.set_cache(LlamaRAMCache(capacity_bytes=PROMPT_CACHE_MB << 20))
+
     _LOADED[model_key] = llm
+    _LAST_USED[model_key] = time.monotonic()
 
     print(f"[llamalith] loaded model={model_key}")
 
     return llm
 
 
+def prewarm(model_keys: Optional[str] = None) -> None:
+    """Load models and run a 1-token completion so their pages are hot before
+    the first real job. Takes a comma-separated list, defaulting to LLM_PREWARM
+    (or the first available model); only the first MAX_RESIDENT are used.
+    Set LLM_PREWARM= (empty) to skip."""
+
+    if model_keys is None:
+        model_keys = os.getenv("LLM_PREWARM", AVAILABLE_MODELS[0] if AVAILABLE_MODELS else "")
+
+    keys = [k.strip() for k in model_keys.split(",") if k.strip()][:MAX_RESIDENT]
+    for model_key in keys:
+        try:
+            with _model_lock(model_key):
+                get_model(model_key)(" ", max_tokens=1)
+            print(f"[llamalith] prewarmed model={model_key}")
+        except Exception as e:
+            logging.warning("[prewarm] %s failed: %s", model_key, e)
+
+
 # ---------- prompt helpers ----------
+class _RoleTags(dict):
+    def __missing__(self, role: str) -> str:
+        return f"[{role.upper()}]\n"
+
+
+_ROLE_TAGS = _RoleTags(
+    system="[SYSTEM]\n",
+    user="[USER]\n",
+    assistant="[ASSISTANT]\n",
+)
+
+
+def _message_text(m: Dict[str, str]) -> str:
+    return f"{_ROLE_TAGS[m.get('role', '')]}{m.get('content', '')}\n"
+
+
 def format_messages(messages: List[Dict[str, str]]) -> str:
     """Plain string representation, used only for token counting."""
 
-    parts = []
+    return "".join([_message_text(m) for m in messages]) + "[ASSISTANT]\n"
 
-    for m in messages:
-        role = m.get("role", "")
-        content = m.get("content", "")
 
-        if role == "system":
-            parts.append(f"[SYSTEM]\n{content}\n")
-        elif role == "user":
-            parts.append(f"[USER]\n{content}\n")
-        elif role == "assistant":
-            parts.append(f"[ASSISTANT]\n{content}\n")
-        else:
-            parts.append(f"[{role.upper()}]\n{content}\n")
+# Token counts per (model, message text digest). A conversation's history comes
+# back every turn with one new message, so only that one is tokenized again.
+# Keyed on a 16-byte digest so cached entries don't keep message text alive.
+_TOKEN_COUNT_MAX = 4096
+_token_counts: "OrderedDict[tuple, int]" = OrderedDict()
+_token_counts_lock = threading.Lock()
 
-    parts.append("[ASSISTANT]\n")
 
-    return "".join(parts)
+def _token_count(llm: Llama, model_key: str, text: str) -> int:
+    data = text.encode("utf-8")
+    key = (model_key, hashlib.blake2b(data, digest_size=16).digest())
+    with _token_counts_lock:
+        n = _token_counts.get(key)
+        if n is not None:
+            _token_counts.move_to_end(key)
+            return n
+    n = len(llm.tokenize(data, add_bos=False))
+    with _token_counts_lock:
+        _token_counts[key] = n
+        if len(_token_counts) > _TOKEN_COUNT_MAX:
+            _token_counts.popitem(last=False)
+    return n
 
 
-def _float_or_none(value: Any) -> Optional[float]:
-    try:
-        return float(value)
-    except Exception:
-        return None
+def count_prompt_tokens(llm: Llama, model_key: str, messages: List[Dict[str, str]]) -> int:
+    """Token estimate for format_messages(messages), summed per message from
+    the cache (plus BOS) instead of re-tokenizing the whole history."""
 
+    return 1 + _token_count(llm, model_key, "[ASSISTANT]\n") + sum(
+        _token_count(llm, model_key, _message_text(m)) for m in messages
+    )
 
-def _int_or(default_value: int, value: Any) -> int:
-    try:
-        return int(value)
-    except Exception:
-        return default_value
 
+def _collect_stream(
+    chunks: Iterable[Dict[str, Any]],
+    on_progress: Callable[[str], None],
+) -> Dict[str, Any]:
+    """Drain a create_chat_completion(stream=True) iterator, reporting partial
+    text, and return a response shaped like the non-streaming one."""
 
-# ---------- inference ----------
-def run_model(
-    model_key: str,
-    messages: List[Dict[str, str]],
-    grammar_name: str = None,
-) -> str:
-    llm = get_model(model_key)
-    s = _settings_for(model_key)
+    parts: List[str] = []
+    finish = None
 
-    # ---- Grammar file option ----
-    grammar_text = None
-    grammar_path = None
+    for i, chunk in enumerate(chunks, 1):
+        choice = (chunk.get("choices") or [{}])[0]
+        piece = (choice.get("delta") or {}).get("content") or choice.get("text") or ""
 
-    if grammar_name:
-        safe = "".join(
-            ch for ch in grammar_name
-            if ch.isalnum() or ch in ("-", "_", ".", "+")
-        )
-        safe = os.path.basename(safe)
+        if piece:
+            parts.append(piece)
 
-        if not safe.endswith(".gbnf"):
-            safe += ".gbnf"
+        finish = choice.get("finish_reason") or finish
 
-        grammar_dir = os.getenv(
-            "LLM_GRAMMAR_DIR",
-            "/home/smithkt/llama.cpp/grammars",
-        )
+        if i % STREAM_FLUSH_EVERY == 0:
+            on_progress("".join(parts))
 
-        grammar_path = os.path.join(grammar_dir, safe)
+    # Streamed chunks carry no usage block; llama.cpp emits about one token per
+    # content chunk, which is close enough for the usage log line and saves
+    # re-tokenizing the whole reply.
+    return {
+        "choices": [
+            {"message": {"content": "".join(parts)}, "finish_reason": finish}
+        ],
+        "usage": {"completion_tokens": len(parts)},
+    }
 
-        try:
-            with open(grammar_path, "r", encoding="utf-8") as gf:
-                grammar_text = gf.read()
-                logging.info("[grammar] using %s", grammar_path)
-        except Exception as e:
-            logging.warning("[grammar] failed to load %s: %s", grammar_path, e)
 
-    # ---- context accounting ----
-    prompt_token_count = None
-    n_ctx = int(os.getenv("LLM_N_CTX", str(s.get("n_ctx", 4096))))
+def _approx_tokens(m: Dict[str, str]) -> int:
+    # ~4 chars/token plus a few for the role wrapper; only used for trimming.
+    return len(m.get("content") or "") // 4 + 4
+
+
+def trim_history(messages: List[Dict[str, str]], budget: int) -> List[Dict[str, str]]:
+    """Drop the oldest turns (keeping a leading system message and always the
+    newest user turn) until the rough token estimate fits within budget. The
+    kept history starts at a user turn, since chat templates that enforce
+    user/assistant alternation reject anything else after the system prompt."""
+
+    head = messages[:1] if messages and messages[0].get("role") == "system" else []
+    body = messages[len(head):]
+    budget -= sum(_approx_tokens(m) for m in head)
+
+    # Running totals from the newest turn backwards; bisect finds how many fit.
+    totals = list(accumulate(_approx_tokens(m) for m in reversed(body)))
+    keep = max(1, bisect_right(totals, budget))
+
+    if keep >= len(body):
+        return messages
+
+    # Move the cut forward to the next user turn; if none is left inside the
+    # budget, back to the newest user turn even though it overshoots.
+    start = len(body) - keep
+    users = [i for i, m in enumerate(body) if m.get("role") == "user"]
+    later = [i for i in users if i >= start]
+    if later:
+        start = later[0]
+    elif users:
+        start = users[-1]
 
+    return head + body[start:]
+
+
+def _float_or_none(value: Any) -> Optional[float]:
     try:
-        prompt_str = format_messages(messages)
-        prompt_tokens = llm.tokenize(prompt_str.encode("utf-8"))
-        prompt_token_count = len(prompt_tokens)
-        remaining_ctx = max(256, n_ctx - prompt_token_count - SAFETY_MARGIN)
+        return float(value)
     except Exception:
-        remaining_ctx = 1024
+        return None
 
-    # ---- max tokens ----
-    max_tokens_cfg = s.get("max_tokens")
-    max_tokens_env = os.getenv("LLM_MAX_TOKENS")
 
-    max_tokens = None
+def _int_or(default_value: int, value: Any) -> int:
+    try:
+        return int(value)
+    except Exception:
+        return default_value
+
+
+@lru_cache(maxsize=None)
+def _sampling_preset(model_key: str) -> Dict[str, Any]:
+    """Per-model settings merged with the LLM_* env overrides, resolved once:
+    both are fixed for the life of the process. Treat as read-only."""
+
+    s = _settings_for(model_key)
 
+    max_tokens = None
+    max_tokens_env = os.getenv("LLM_MAX_TOKENS")
     if max_tokens_env is not None:
         try:
             max_tokens = int(max_tokens_env)
         except ValueError:
             max_tokens = None
-    elif isinstance(max_tokens_cfg, int):
-        max_tokens = max_tokens_cfg
+    elif isinstance(s.get("max_tokens"), int):
+        max_tokens = s["max_tokens"]
 
-    max_tokens_final = max(1, min(max_tokens or remaining_ctx, remaining_ctx))
-
-    # ---- sampling/decoding params ----
     params = {
         "temperature": float(os.getenv("LLM_TEMP", str(s.get("temperature", 0.8)))),
         "top_p": float(os.getenv("LLM_TOP_P", str(s.get("top_p", 0.9)))),
@@ -253,9 +487,8 @@ def run_model(
         "repeat_penalty": float(
             os.getenv("LLM_REPEAT_PENALTY", str(s.get("repeat_penalty", 1.07)))
         ),
-        "max_tokens": max_tokens_final,
     }
-    
+
     # optional typical_p
     try:
         typical_p = os.getenv("LLM_TYPICAL_P", str(s.get("typical_p", 0.97)))
@@ -299,7 +532,7 @@ def run_model(
     if stop:
         params["stop"] = stop
 
-    # ---- EOS + END-token logit bias ----
+    # ---- EOS bias ----
     eos_bias_value = None
 
     try:
@@ -313,6 +546,107 @@ def run_model(
     except Exception:
         eos_bias_value = None
 
+    # ---- logit bias adapter key ----
+    candidate_bias_keys = []
+
+    pref_key = os.getenv("LLM_LOGIT_BIAS_KEY", s.get("logit_bias_key", None))
+
+    if pref_key:
+        candidate_bias_keys.append(pref_key)
+
+    for key in ("logit_bias", "logit-bias", "logit_bias_map"):
+        if key not in candidate_bias_keys:
+            candidate_bias_keys.append(key)
+
+    return {
+        "n_ctx": int(os.getenv("LLM_N_CTX", str(s.get("n_ctx", 4096)))),
+        "max_tokens": max_tokens,
+        "params": params,
+        "end_token": end_token_str,
+        "require_end": require_end,
+        "eos_bias": eos_bias_value,
+        "bias_keys": tuple(candidate_bias_keys),
+        "max_continues": _int_or(
+            1,
+            os.getenv("STORY_MAX_CONTINUES", s.get("max_continues", 1)),
+        ),
+    }
+
+
+# ---------- inference ----------
+def run_model(
+    model_key: str,
+    messages: List[Dict[str, str]],
+    grammar_name: str = None,
+    on_progress: Optional[Callable[[str], None]] = None,
+) -> str:
+    with _model_lock(model_key):
+        try:
+            return _run_model(model_key, messages, grammar_name, on_progress)
+        finally:
+            # Still under the model lock, so unload_idle never sees the model
+            # free with the stamp from before this job.
+            _touch(model_key)
+
+
+def _run_model(
+    model_key: str,
+    messages: List[Dict[str, str]],
+    grammar_name: str = None,
+    on_progress: Optional[Callable[[str], None]] = None,
+) -> str:
+    llm = get_model(model_key)
+    preset = _sampling_preset(model_key)
+
+    # ---- Grammar file option ----
+    grammar_text = None
+    grammar_path = None
+
+    if grammar_name:
+        safe = "".join(
+            ch for ch in grammar_name
+            if ch.isalnum() or ch in ("-", "_", ".", "+")
+        )
+        safe = os.path.basename(safe)
+
+        if not safe.endswith(".gbnf"):
+            safe += ".gbnf"
+
+        grammar_path = os.path.join(GRAMMAR_DIR, safe)
+
+        try:
+            with open(grammar_path, "r", encoding="utf-8") as gf:
+                grammar_text = gf.read()
+                logging.info("[grammar] using %s", grammar_path)
+        except Exception as e:
+            logging.warning("[grammar] failed to load %s: %s", grammar_path, e)
+
+    # ---- context accounting ----
+    prompt_token_count = None
+    n_ctx = preset["n_ctx"]
+
+    trimmed = trim_history(messages, n_ctx - SAFETY_MARGIN - HISTORY_RESERVE)
+    if len(trimmed) != len(messages):
+        logging.info("[context] trimmed history %d -> %d messages", len(messages), len(trimmed))
+        messages = trimmed
+
+    try:
+        prompt_token_count = count_prompt_tokens(llm, model_key, messages)
+        remaining_ctx = max(256, n_ctx - prompt_token_count - SAFETY_MARGIN)
+    except Exception:
+        remaining_ctx = 1024
+
+    # ---- max tokens ----
+    max_tokens = preset["max_tokens"]
+    max_tokens_final = max(1, min(max_tokens or remaining_ctx, remaining_ctx))
+
+    # ---- sampling/decoding params ----
+    params = dict(preset["params"], max_tokens=max_tokens_final)
+
+    end_token_str = preset["end_token"]
+    require_end = preset["require_end"]
+    eos_bias_value = preset["eos_bias"]
+
     bias_map = None
     end_token_ids = []
 
@@ -361,18 +695,6 @@ def run_model(
         else:
             logging.warning("[grammar] disabled due to construction error")
 
-    # ---- logit bias adapter key ----
-    candidate_bias_keys = []
-
-    pref_key = os.getenv("LLM_LOGIT_BIAS_KEY", s.get("logit_bias_key", None))
-
-    if pref_key:
-        candidate_bias_keys.append(pref_key)
-
-    for key in ("logit_bias", "logit-bias", "logit_bias_map"):
-        if key not in candidate_bias_keys:
-            candidate_bias_keys.append(key)
-
     # ---- Logging ----
     if prompt_token_count is not None:
         logging.info(
@@ -418,15 +740,23 @@ def run_model(
         if with_bias_key and bias_map:
             call_params[with_bias_key] = bias_map
 
-        return llm.create_chat_completion(
+        if on_progress is None:
+            return llm.create_chat_completion(
+                messages=(given_messages or messages),
+                **call_params,
+            )
+
+        chunks = llm.create_chat_completion(
             messages=(given_messages or messages),
+            stream=True,
             **call_params,
         )
+        return _collect_stream(chunks, on_progress)
 
     response = None
 
     if bias_map:
-        for key in candidate_bias_keys:
+        for key in preset["bias_keys"]:
             try:
                 response = _try_call(key)
                 bias_key_used = key
@@ -497,10 +827,7 @@ def run_model(
     )
 
     # ---- Require-end enforcement ----
-    max_continues = _int_or(
-        1,
-        os.getenv("STORY_MAX_CONTINUES", s.get("max_continues", 1)),
-    )
+    max_continues = preset["max_continues"]
 
     continues = 0
 
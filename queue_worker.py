@@ -1,9 +1,10 @@
 # queue_worker.py
-import multiprocessing
+import threading
 import time
 import sys
 import re
 import logging, os, traceback
+from concurrent.futures import ThreadPoolExecutor
 
 CONFIG_PATH = os.getenv("LLAMALITH_CONFIG", "config.json")
 _story_cfg = {}
@@ -21,19 +22,29 @@ if os.path.exists(CONFIG_PATH):
         _worker_count = 2
 
 from memory import (
+    get_db_connection,
+    get_read_connection,
     claim_next_job,
+    wait_for_job,
     get_conversation_messages,
-    save_assistant_message,
+    finish_job,
+    flush_writes,
     mark_job_done,
+    update_job_progress,
 )
-from model_runner import run_model
+from model_runner import free_resident_models, pin_cpus, prewarm, run_model, unload_idle
 
-POLL_SEC = 1
+# Workers sleep on the wakeup FIFO; this is the fallback re-check interval,
+# and the pickup latency whenever the API can't reach the FIFO.
+POLL_SEC = float(os.getenv("WORKER_IDLE_WAIT_SEC", "1"))
 NUM_WORKERS = _worker_count
+# Jobs for loaded models that no job is running on are claimed first, unless
+# an older job for another model has waited this long.
+AFFINITY_MAX_WAIT_SEC = int(os.getenv("WORKER_AFFINITY_MAX_WAIT_SEC", "120"))
 
 logging.basicConfig(
     level=logging.INFO,
-    format='[Worker %(process)d] %(asctime)s %(levelname)s %(message)s',
+    format='[Worker %(process)d %(threadName)s] %(asctime)s %(levelname)s %(message)s',
     handlers=[logging.StreamHandler(sys.stdout)]
 )
 
@@ -76,101 +87,123 @@ def is_probably_ssml(system_prompt: str, text: str) -> bool:
     return ("ssml" in sp) or ("<speak" in t and "</speak" in t)
 
 # ---- main worker ----
-def worker_loop(worker_id: int):
-    print(f"🚀 Worker {worker_id} started.", flush=True)
-    while True:
-        try:
-            job = claim_next_job()
-            if not job:
-                time.sleep(POLL_SEC)
-                continue
-
-            jid = job["id"]
-            convo_id = job["conversation_id"]
-            model_key = job["model"]
-            user_input = (job.get("user_input") or "").strip()
-            system_prompt = (job.get("system_prompt") or "").strip()
-            grammar_name = (job.get("grammar_name") or "").strip() or None
-
-            logging.info(f"claimed job={jid} model={model_key} convo={convo_id} ulen={len(user_input)}")
+def process_job(job: dict):
+    try:
+        jid = job["id"]
+        convo_id = job["conversation_id"]
+        model_key = job["model"]
+        user_input = (job.get("user_input") or "").strip()
+        system_prompt = (job.get("system_prompt") or "").strip()
+        grammar_name = (job.get("grammar_name") or "").strip() or None
+
+        logging.info(f"claimed job={jid} model={model_key} convo={convo_id} ulen={len(user_input)}")
+
+        # Build history from DB. The previous job's reply may still be queued
+        # in the write-behind batcher; apply it first so this turn sees it.
+        flush_writes()
+        history = get_conversation_messages(convo_id) or []
+
+        # Ensure current user turn is present
+        if user_input and (not history or history[-1].get("role") != "user" or history[-1].get("content","").strip() != user_input):
+            history.append({"role": "user", "content": user_input})
+
+        # Ensure system prompt at top (avoid dup)
+        if system_prompt and (not history or history[0].get("role") != "system" or history[0].get("content","").strip() != system_prompt):
+            history.insert(0, {"role": "system", "content": system_prompt})
+
+        logging.info(f"history_turns={len(history)}; calling model…")
+        reply = (run_model(
+            model_key,
+            history,
+            grammar_name=grammar_name,
+            on_progress=lambda partial: update_job_progress(jid, partial),
+        ) or "").strip()
+        logging.info(f"reply_len={len(reply)}")
+
+        if not reply:
+            mark_job_done(jid, failed=True, result_text="Empty model output")
+            logging.warning(f"empty output -> marked job {jid} failed")
+            return
+
+        # ---- SSML length guard (ONLY if this looks like SSML) ----
+        if is_probably_ssml(system_prompt, reply):
+            inner = extract_inner_ssml(reply)
+            wc = word_count(strip_ssml_tags(inner))
+            continues_left = MAX_CONTINUES
+
+            # Build a local history that includes the assistant reply so far
+            local_history = list(history)
+            local_history.append({"role": "assistant", "content": wrap_speak(inner)})
+
+            while wc < TARGET_MIN_WORDS and continues_left > 0:
+                need = TARGET_MIN_WORDS - wc
+                # Ask the model to continue the SAME story, no new <speak> wrapper
+                cont_prompt = (
+                    "Continue the SAME bedtime story in the same tone and setting. "
+                    f"Add new paragraphs to reach at least {TARGET_MIN_WORDS} words total. "
+                    "Do NOT repeat earlier lines. Output ONLY the continuation content "
+                    "without starting with <speak> or ending with </speak>. "
+                    "Keep <break time=\"1.2s\"/> between paragraphs and occasional "
+                    "<break time=\"400ms\"/> between sentences."
+                )
+                local_history.append({"role": "user", "content": cont_prompt})
+                cont = (run_model(model_key, local_history) or "").strip()
+                cont_inner = extract_inner_ssml(cont)
+
+                # Stitch with a paragraph break
+                inner = inner.rstrip() + '\n<break time="1.2s"/>\n' + cont_inner.lstrip()
+                wc = word_count(strip_ssml_tags(inner))
+                # Replace last assistant in local history with the updated stitched version
+                local_history[-2] = {"role": "assistant", "content": wrap_speak(inner)}
+                continues_left -= 1
 
-            # Build history from DB
-            history = get_conversation_messages(convo_id) or []
+            reply = normalize_speak_once(inner)
+            logging.info(f"final_word_count={wc}")
 
-            # Ensure current user turn is present
-            if user_input and (not history or history[-1].get("role") != "user" or history[-1].get("content","").strip() != user_input):
-                history.append({"role": "user", "content": user_input})
+        # Save final result (SSML stitched or original)
+        finish_job(jid, convo_id, reply)
+        logging.info(f"✅ Finished job {jid}")
 
-            # Ensure system prompt at top (avoid dup)
-            if system_prompt and (not history or history[0].get("role") != "system" or history[0].get("content","").strip() != system_prompt):
-                history.insert(0, {"role": "system", "content": system_prompt})
+    except Exception as e:
+        logging.exception(f"❌ Failed job {jid if 'jid' in locals() else '?'}: {e}")
+        try:
+            if 'jid' in locals():
+                mark_job_done(jid, failed=True, result_text=str(e))
+        except Exception:
+            logging.exception("failed to mark job as error")
 
-            logging.info(f"history_turns={len(history)}; calling model…")
-            reply = (run_model(model_key, history, grammar_name=grammar_name) or "").strip()
-            logging.info(f"reply_len={len(reply)}")
+def worker_init():
+    # Runs once per job thread: open its long-lived DB connections up front
+    # instead of on the first job.
+    get_db_connection()
+    get_read_connection()
 
-            if not reply:
-                mark_job_done(jid, failed=True, result_text="Empty model output")
-                logging.warning(f"empty output -> marked job {jid} failed")
-                continue
-
-            # ---- SSML length guard (ONLY if this looks like SSML) ----
-            if is_probably_ssml(system_prompt, reply):
-                inner = extract_inner_ssml(reply)
-                wc = word_count(strip_ssml_tags(inner))
-                continues_left = MAX_CONTINUES
-
-                # Build a local history that includes the assistant reply so far
-                local_history = list(history)
-                local_history.append({"role": "assistant", "content": wrap_speak(inner)})
-
-                while wc < TARGET_MIN_WORDS and continues_left > 0:
-                    need = TARGET_MIN_WORDS - wc
-                    # Ask the model to continue the SAME story, no new <speak> wrapper
-                    cont_prompt = (
-                        "Continue the SAME bedtime story in the same tone and setting. "
-                        f"Add new paragraphs to reach at least {TARGET_MIN_WORDS} words total. "
-                        "Do NOT repeat earlier lines. Output ONLY the continuation content "
-                        "without starting with <speak> or ending with </speak>. "
-                        "Keep <break time=\"1.2s\"/> between paragraphs and occasional "
-                        "<break time=\"400ms\"/> between sentences."
-                    )
-                    local_history.append({"role": "user", "content": cont_prompt})
-                    cont = (run_model(model_key, local_history) or "").strip()
-                    cont_inner = extract_inner_ssml(cont)
-
-                    # Stitch with a paragraph break
-                    inner = inner.rstrip() + '\n<break time="1.2s"/>\n' + cont_inner.lstrip()
-                    wc = word_count(strip_ssml_tags(inner))
-                    # Replace last assistant in local history with the updated stitched version
-                    local_history[-2] = {"role": "assistant", "content": wrap_speak(inner)}
-                    continues_left -= 1
-
-                reply = normalize_speak_once(inner)
-                logging.info(f"final_word_count={wc}")
-
-            # Save final result (SSML stitched or original)
-            save_assistant_message(convo_id, reply)
-            mark_job_done(jid, failed=False, result_text=reply)
-            logging.info(f"✅ Finished job {jid}")
-
-        except Exception as e:
-            logging.exception(f"❌ Failed job {jid if 'jid' in locals() else '?'}: {e}")
+def main():
+    # One process, NUM_WORKERS job threads sharing the loaded model (llama.cpp
+    # drops the GIL during inference). The main thread claims a job only when
+    # a slot is free, so nothing sits 'processing' while waiting for a thread.
+    print(f"🚀 Worker started with {NUM_WORKERS} job threads.", flush=True)
+    pin_cpus()
+    prewarm()
+    slots = threading.BoundedSemaphore(NUM_WORKERS)
+    with ThreadPoolExecutor(
+        max_workers=NUM_WORKERS, thread_name_prefix="job", initializer=worker_init
+    ) as pool:
+        while True:
+            slots.acquire()
             try:
-                if 'jid' in locals():
-                    mark_job_done(jid, failed=True, result_text=str(e))
+                job = claim_next_job(free_resident_models(), AFFINITY_MAX_WAIT_SEC)
             except Exception:
-                logging.exception("failed to mark job as error")
-            time.sleep(0.5)  # small backoff on exceptions
-
-def main():
-    procs = []
-    for i in range(NUM_WORKERS):
-        p = multiprocessing.Process(target=worker_loop, args=(i + 1,))
-        p.start()
-        procs.append(p)
-    for p in procs:
-        p.join()
+                logging.exception("failed to claim job")
+                slots.release()
+                time.sleep(0.5)  # small backoff on exceptions
+                continue
+            if not job:
+                slots.release()
+                unload_idle()
+                wait_for_job(POLL_SEC)
+                continue
+            pool.submit(process_job, job).add_done_callback(lambda _: slots.release())
 
 if __name__ == "__main__":
     main()
@@ -9,5 +9,5 @@ fi
 export LLAMALITH_CONFIG=config.json
 
 # Run FastAPI app
-uvicorn main:app --host 0.0.0.0 --port 8000 --reload
+uvicorn main:app --host 0.0.0.0 --port 8000 --loop uvloop --http httptools --reload
 
@@ -0,0 +1,102 @@
+# session_middleware.py
+# Minimal pure-ASGI signed-cookie session, wire-compatible with
+# starlette.middleware.sessions.SessionMiddleware (same signer + encoding), so
+# existing browser sessions keep working. The payload is compact JSON via
+# orjson; starlette's json.loads reads it the same.
+import time
+from base64 import b64decode, b64encode
+
+import itsdangerous
+import orjson
+from itsdangerous.exc import BadSignature
+
+
+class SessionMiddleware:
+    def __init__(
+        self,
+        app,
+        secret_key: str,
+        session_cookie: str = "session",
+        max_age: int = 14 * 24 * 60 * 60,
+        path: str = "/",
+        same_site: str = "lax",
+        https_only: bool = False,
+        refresh_after: int = 60 * 60,
+    ):
+        self.app = app
+        self.signer = itsdangerous.TimestampSigner(str(secret_key))
+        self.session_cookie = session_cookie
+        self.max_age = max_age
+        self.path = path
+        # An unchanged session is only re-signed (sliding the expiry) once the
+        # browser's cookie is this old; otherwise no Set-Cookie is sent at all.
+        self.refresh_after = refresh_after
+        self.security_flags = "httponly; samesite=" + same_site
+        if https_only:
+            self.security_flags += "; secure"
+
+    def _raw_cookie(self, scope):
+        # Lenient split like starlette's cookie_parser; only our cookie matters.
+        prefix = self.session_cookie + "="
+        for name, value in scope["headers"]:
+            if name != b"cookie":
+                continue
+            for chunk in value.decode("latin-1").split(";"):
+                chunk = chunk.strip()
+                if chunk.startswith(prefix):
+                    return chunk[len(prefix):].strip('"')
+        return None
+
+    def _load(self, scope):
+        """Return (session, payload json bytes, signed-at epoch seconds)."""
+        raw = self._raw_cookie(scope)
+        if not raw:
+            return {}, None, 0.0
+        try:
+            data, signed_at = self.signer.unsign(
+                raw.encode(), max_age=self.max_age, return_timestamp=True
+            )
+            payload = b64decode(data)
+            return orjson.loads(payload), payload, signed_at.timestamp()
+        except (BadSignature, ValueError):
+            return {}, None, 0.0
+
+    def _cookie_header(self, payload: bytes) -> bytes:
+        data = self.signer.sign(b64encode(payload))
+        max_age = f"Max-Age={self.max_age}; " if self.max_age else ""
+        return (
+            f"{self.session_cookie}={data.decode()}; path={self.path}; "
+            f"{max_age}{self.security_flags}"
+        ).encode("latin-1")
+
+    def _clear_header(self) -> bytes:
+        return (
+            f"{self.session_cookie}=null; path={self.path}; "
+            f"expires=Thu, 01 Jan 1970 00:00:00 GMT; {self.security_flags}"
+        ).encode("latin-1")
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] not in ("http", "websocket"):
+            await self.app(scope, receive, send)
+            return
+
+        session, loaded_payload, signed_at = self._load(scope)
+        had_session = bool(session)
+        scope["session"] = session
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                current = scope["session"]
+                if current:
+                    payload = orjson.dumps(current)
+                    fresh = time.time() - signed_at < self.refresh_after
+                    header = None if payload == loaded_payload and fresh else self._cookie_header(payload)
+                elif had_session:
+                    header = self._clear_header()
+                else:
+                    header = None
+                if header is not None:
+                    message["headers"] = list(message.get("headers", [])) + [(b"set-cookie", header)]
+            await send(message)
+
+        await self.app(scope, receive, send_wrapper)
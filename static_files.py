@@ -0,0 +1,38 @@
+# static_files.py
+# StaticFiles that serves a pre-generated sibling (app.js.br / app.js.gz) when
+# the client accepts that encoding. Generate them at deploy time, e.g.
+#   gzip -k -9 static/*.js static/*.css   (and/or: brotli -k -q 11 ...)
+from mimetypes import guess_type
+
+from starlette.datastructures import Headers
+from starlette.responses import FileResponse
+from starlette.staticfiles import NotModifiedResponse, StaticFiles
+
+_ENCODINGS = ((".br", "br"), (".gz", "gzip"))
+
+
+class PrecompressedStaticFiles(StaticFiles):
+    async def get_response(self, path: str, scope):
+        if scope["method"] in ("GET", "HEAD"):
+            request_headers = Headers(scope=scope)
+            accepted = {
+                token.split(";")[0].strip()
+                for token in request_headers.get("accept-encoding", "").split(",")
+            }
+            for ext, encoding in _ENCODINGS:
+                if encoding not in accepted:
+                    continue
+                full_path, stat_result = self.lookup_path(path + ext)
+                if stat_result is None:
+                    continue
+                response = FileResponse(
+                    full_path,
+                    stat_result=stat_result,
+                    media_type=guess_type(path)[0] or "application/octet-stream",
+                    headers={"content-encoding": encoding, "vary": "Accept-Encoding"},
+                )
+                if self.is_not_modified(response.headers, request_headers):
+                    return NotModifiedResponse(response.headers)
+                return response
+
+        return await super().get_response(path, scope)